@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+"""
+Benchmark the encoding of ska_api table results.
+
+This times APIEncoder (rows and columns table formats, strict and non-strict encoding, NDJSON
+streaming), _replace_object_cols_with_str and the typed table formats on synthetic astropy Tables
+shaped like the outputs of kadi get_states and get_cmds, and agasc get_agasc_cone. No network
+access or Ska data are needed.
+
+For each case it reports the best time of a few repeats, the throughput (rows/s and MB/s of
+output) and the peak memory allocated while encoding (measured with tracemalloc in a separate
+run). Results are compared to a stored baseline::
+
+    python benchmarks/bench_ska_api_encoding.py
+    python benchmarks/bench_ska_api_encoding.py --sizes 1000000 --shapes states
+    python benchmarks/bench_ska_api_encoding.py --save-baseline
+
+The baseline is machine-specific, so regenerate it before comparing on a different machine.
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+from astropy.table import Table, MaskedColumn
+from astropy.time import Time
+
+from kadi_apps.blueprints.ska_api import formats
+from kadi_apps.blueprints.ska_api.api import APIEncoder, _replace_object_cols_with_str
+
+
+BASELINE = Path(__file__).parent / 'ska_api_encoding_baseline.json'
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+
+
+def get_states(n, rng):
+    """Table like kadi.commands.states.get_states, with an object column of sets"""
+    tstart = 7.8e8 + np.cumsum(rng.uniform(10, 5000, n))
+    tstop = np.append(tstart[1:], tstart[-1] + 100)
+    pcad_modes = np.array(['NPNT', 'NMAN', 'STBY', 'NSUN'])
+    table = Table()
+    table['datestart'] = Time(tstart, format='cxcsec').yday.astype('S21')
+    table['datestop'] = Time(tstop, format='cxcsec').yday.astype('S21')
+    table['tstart'] = tstart
+    table['tstop'] = tstop
+    table['obsid'] = rng.integers(0, 65536, n)
+    table['pcad_mode'] = pcad_modes[rng.integers(0, 4, n)]
+    table['pitch'] = rng.uniform(45, 180, n)
+    table['off_nom_roll'] = rng.uniform(-20, 20, n)
+    for name in ['q1', 'q2', 'q3', 'q4']:
+        table[name] = rng.uniform(-1, 1, n)
+    table['simpos'] = rng.integers(-100000, 100000, n)
+    table['hetg'] = np.where(rng.uniform(size=n) > 0.9, 'INSR', 'RETR')
+    trans_keys = np.empty(n, dtype=object)
+    trans_keys[:] = [{'obsid', 'pitch'} if ii % 2 else {'pcad_mode'} for ii in range(n)]
+    table['trans_keys'] = trans_keys
+    return table
+
+
+def get_cmds(n, rng):
+    """Table like kadi.commands.get_cmds, with an object column of (JSON-compatible) dicts"""
+    times = 7.8e8 + np.cumsum(rng.uniform(0.1, 500, n))
+    types = np.array([b'COMMAND_SW', b'COMMAND_HW', b'ACISPKT', b'MP_OBSID', b'ORBPOINT'])
+    table = Table()
+    table['idx'] = np.arange(n, dtype=np.int32)
+    table['date'] = Time(times, format='cxcsec').yday.astype('S21')
+    table['type'] = types[rng.integers(0, len(types), n)]
+    table['tlmsid'] = np.char.add(b'AO', rng.integers(0, 1000, n).astype('S4'))
+    table['scs'] = rng.integers(128, 134, n).astype(np.uint8)
+    table['step'] = rng.integers(0, 2000, n).astype(np.uint16)
+    table['time'] = times
+    table['source'] = np.full(n, b'JAN0123A')
+    table['vcdu'] = rng.integers(0, 2**24, n).astype(np.int32)
+    params = np.empty(n, dtype=object)
+    params[:] = [{'event_type': 'XQF', 'scs': 131, 'id': ii} for ii in range(n)]
+    table['params'] = params
+    return table
+
+
+def get_agasc_cone(n, rng):
+    """Table like agasc.get_agasc_cone, with masked columns"""
+    table = Table()
+    table['AGASC_ID'] = rng.integers(0, 2**31 - 1, n).astype(np.int32)
+    table['RA'] = rng.uniform(0, 360, n)
+    table['DEC'] = rng.uniform(-90, 90, n)
+    table['PM_RA'] = rng.integers(-1000, 1000, n).astype(np.int16)
+    table['PM_DEC'] = rng.integers(-1000, 1000, n).astype(np.int16)
+    table['EPOCH'] = np.full(n, 2000.0, dtype=np.float32)
+    table['MAG_ACA'] = rng.uniform(5, 12, n).astype(np.float32)
+    table['MAG_ACA_ERR'] = rng.integers(0, 100, n).astype(np.int16)
+    table['CLASS'] = rng.integers(0, 3, n).astype(np.int16)
+    table['COLOR1'] = rng.uniform(-0.5, 1.5, n).astype(np.float32)
+    table['VAR'] = MaskedColumn(
+        rng.integers(0, 10, n).astype(np.int16), mask=rng.uniform(size=n) > 0.1
+    )
+    table['RV'] = MaskedColumn(rng.uniform(-100, 100, n), mask=rng.uniform(size=n) > 0.3)
+    table['ASPQ1'] = rng.integers(0, 100, n).astype(np.int16)
+    return table
+
+
+SHAPES = {
+    'states': get_states,
+    'cmds': get_cmds,
+    'agasc_cone': get_agasc_cone,
+}
+
+
+def get_cases():
+    """Return a dict of benchmark name -> function of a table returning bytes or str
+
+    Time columns are not JSON-serializable by APIEncoder, so the tables used in the JSON cases do
+    not have one. The typed formats (npz, ecsv, fits, arrow) use a table with an extra Time column.
+    """
+    def ndjson(table):
+        return ''.join(APIEncoder().iterencode_ndjson(table))
+
+    def non_strict(table):
+        # a dict with a table and non-serializable values goes through APIEncoder.default
+        return APIEncoder(strict_encode=False).encode({'result': table, 'meta': [object()]})
+
+    cases = {
+        'replace_object_cols': lambda table: _replace_object_cols_with_str(table),
+        'json_rows': lambda table: APIEncoder(table_format='rows').encode(table),
+        'json_columns': lambda table: APIEncoder(table_format='columns').encode(table),
+        'json_non_strict': non_strict,
+        'ndjson': ndjson,
+    }
+    for fmt in formats.FORMATS:
+        if formats.is_available(fmt):
+            cases[fmt] = (lambda fmt: lambda table: formats.encode_table(table, fmt))(fmt)
+    return cases
+
+
+def with_time_column(table):
+    table = table.copy(copy_data=False)
+    table['tstamp'] = Time(7.8e8 + np.arange(len(table)), format='cxcsec')
+    return table
+
+
+def run_case(func, table, repeat):
+    """Return the best time of ``repeat`` runs, the output size and the peak memory"""
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        output = func(table)
+        times.append(time.perf_counter() - t0)
+    size = len(output) if isinstance(output, (str, bytes)) else 0
+    del output
+
+    tracemalloc.start()
+    output = func(table)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del output
+    return min(times), size, peak
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument(
+        '--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+        help=f'number of table rows (default: {" ".join(str(n) for n in DEFAULT_SIZES)})',
+    )
+    parser.add_argument(
+        '--shapes', nargs='+', choices=list(SHAPES), default=list(SHAPES),
+        help='table shapes (default: all)',
+    )
+    parser.add_argument('--cases', nargs='+', help='benchmark cases (default: all)')
+    parser.add_argument('--repeat', type=int, default=3, help='timing repeats (default: 3)')
+    parser.add_argument('--baseline', type=Path, default=BASELINE, help='baseline file')
+    parser.add_argument(
+        '--save-baseline', action='store_true',
+        help='store the results in the baseline file (merged with existing results)',
+    )
+    parser.add_argument(
+        '--tolerance', type=float, default=1.25,
+        help='time ratio to the baseline above which a case is a regression (default: 1.25)',
+    )
+    return parser
+
+
+def main():
+    args = get_parser().parse_args()
+    cases = get_cases()
+    if args.cases:
+        unknown = set(args.cases) - set(cases)
+        if unknown:
+            sys.exit(f'unknown or unavailable cases: {", ".join(sorted(unknown))}')
+        cases = {name: cases[name] for name in args.cases}
+
+    baseline = json.loads(args.baseline.read_text()) if args.baseline.exists() else {}
+    baseline_results = baseline.get('results', {})
+    rng = np.random.default_rng(0)
+    results = {}
+    regressions = []
+
+    # warm up (imports and first-call overheads) so they are not counted in the first case
+    for shape in args.shapes:
+        table = SHAPES[shape](10, rng)
+        for case, func in cases.items():
+            try:
+                func(with_time_column(table) if case in formats.FORMATS else table)
+            except Exception:
+                pass
+
+    print(f'{"case":42s} {"time":>9s} {"rows/s":>10s} {"MB/s":>8s} {"peak MB":>8s} {"vs base":>8s}')
+    for shape in args.shapes:
+        for n_rows in args.sizes:
+            table = SHAPES[shape](n_rows, rng)
+            time_table = with_time_column(table)
+            for case, func in cases.items():
+                key = f'{shape}/{n_rows}/{case}'
+                case_table = time_table if case in formats.FORMATS else table
+                try:
+                    seconds, size, peak = run_case(func, case_table, args.repeat)
+                except Exception as e:
+                    print(f'{key:42s} failed: {type(e).__name__}: {e}')
+                    continue
+                results[key] = {'seconds': seconds, 'bytes': size, 'peak_bytes': peak}
+                ratio = ''
+                if key in baseline_results:
+                    ratio = seconds / baseline_results[key]['seconds']
+                    if ratio > args.tolerance:
+                        regressions.append(key)
+                    ratio = f'{ratio:.2f}x'
+                print(
+                    f'{key:42s} {seconds * 1000:7.1f}ms {n_rows / seconds:10.3g} '
+                    f'{size / seconds / 1e6:8.1f} {peak / 1e6:8.1f} {ratio:>8s}'
+                )
+
+    if args.save_baseline:
+        import astropy
+        baseline = {
+            'machine': {
+                'platform': platform.platform(),
+                'processor': platform.processor() or platform.machine(),
+                'python': platform.python_version(),
+                'numpy': np.__version__,
+                'astropy': astropy.__version__,
+            },
+            'results': {**baseline_results, **results},
+        }
+        args.baseline.write_text(json.dumps(baseline, indent=2, sort_keys=True) + '\n')
+        print(f'saved baseline to {args.baseline}')
+    elif regressions:
+        print(f'\n{len(regressions)} case(s) slower than the baseline by more than '
+              f'{args.tolerance}x:')
+        for key in regressions:
+            print(f'  {key}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
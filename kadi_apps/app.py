@@ -13,6 +13,7 @@ from pathlib import Path
 from flask import Flask
 from flask_cors import CORS
 from kadi_apps.rendering import render_template
+from kadi_apps import compression
 
 import pyyaks.logger
 
@@ -70,6 +71,8 @@ def get_app(name=__name__, settings='devel'):
 
     pyyaks.logger.get_logger(name='kadi_apps', level=app.config['LOG_LEVEL'])
 
+    compression.init_app(app)
+
     app.register_error_handler(404, page_not_found)
     app.register_error_handler(500, internal_error)
 
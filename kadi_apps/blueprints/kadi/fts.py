@@ -0,0 +1,196 @@
+"""
+Full-text index of the text fields of kadi events.
+
+Free-text filters of the event browser (e.g. ``safe`` for major events) are ``icontains``
+lookups, which SQLite runs as ``LIKE '%safe%'`` over every row. This module keeps a sidecar
+SQLite database with an FTS5 table (with the trigram tokenizer, which matches any substring of at
+least three characters) per model in FTS_FIELDS, so these lookups use an index instead.
+
+The sidecar database is brought up to date with the events database whenever the latter changes
+(its version, i.e. its mtime, is stored with each table). Only the events that were added,
+removed or changed are written. The sidecar database is attached to the Django connection, so the
+index is used as a subquery of the event queries.
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+from pathlib import Path
+from contextlib import closing
+
+
+# Indexed text fields, keyed by event model name
+FTS_FIELDS = {
+    'major_event': ['descr', 'note'],
+    'cap': ['title', 'descr', 'notes'],
+    'dsn_comm': ['activity'],
+}
+
+# the trigram tokenizer cannot match shorter strings
+MIN_LENGTH = 3
+
+
+class FtsIndex:
+    """
+    Sidecar full-text index of the kadi events database.
+
+    :param path: str or Path
+        Path of the sidecar database. It is created if it does not exist.
+    :param get_version: callable
+        Function that returns the version of the kadi events database (e.g. its mtime).
+    """
+
+    def __init__(self, path, get_version):
+        self.path = Path(path)
+        self.get_version = get_version
+        self._version = None
+        # version of the events database for which the index failed. It is not used until the
+        # database changes.
+        self._failed_version = None
+        self._lock = threading.Lock()
+
+    def can_search(self, model, field_name, text):
+        """Check whether a ``<field_name>__icontains=<text>`` lookup can use the index"""
+        model_name = _get_model_name(model)
+        return (
+            model_name in FTS_FIELDS
+            and field_name in FTS_FIELDS[model_name]
+            and len(text) >= MIN_LENGTH
+            and (self._failed_version is None or self._failed_version != self.get_version())
+        )
+
+    def filter(self, queryset, field_name, text):
+        """Same as ``queryset.filter(<field_name>__icontains=text)``, using the index"""
+        from django.db.models.expressions import RawSQL
+
+        model_name = _get_model_name(queryset.model)
+        try:
+            self.update()
+            self._attach()
+        except Exception as e:
+            # e.g. the index is locked by another worker for too long
+            logging.getLogger('kadi_apps').warning(
+                f'kadi FTS index: not used until the events database changes '
+                f'({type(e).__name__}: {e})'
+            )
+            self._failed_version = self.get_version()
+            return queryset.filter(**{f'{field_name}__icontains': text})
+        subquery = RawSQL(
+            f'SELECT pk FROM kadi_fts.{model_name} WHERE {model_name} MATCH %s',
+            [_get_match(field_name, text)],
+        )
+        return queryset.filter(pk__in=subquery)
+
+    def search(self, model_name, text, field_name=None, limit=None):
+        """Return the primary keys of the events matching a text, best matches first
+
+        Matches are ranked with the FTS5 bm25 function.
+
+        :param field_name: str
+            Field to search. Default is all the indexed fields of the model.
+        :returns: list
+        """
+        self.update()
+        sql = f'SELECT pk FROM {model_name} WHERE {model_name} MATCH ? ORDER BY rank'
+        params = [_get_match(field_name, text)]
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        with closing(sqlite3.connect(self.path)) as db:
+            return [pk for pk, in db.execute(sql, params)]
+
+    def update(self):
+        """Bring the index up to date with the events database"""
+        version = self.get_version()
+        if version == self._version:
+            return
+        with self._lock:
+            if version == self._version:
+                return
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            try:
+                # other workers might be updating the index too
+                db.execute('BEGIN IMMEDIATE')
+                db.execute(
+                    'CREATE TABLE IF NOT EXISTS versions '
+                    '(model TEXT PRIMARY KEY, fields TEXT, version INTEGER)'
+                )
+                for model_name, field_names in FTS_FIELDS.items():
+                    self._update_table(db, model_name, field_names, version)
+                db.execute('COMMIT')
+            except Exception:
+                db.execute('ROLLBACK')
+                raise
+            finally:
+                db.close()
+            self._version = version
+
+    def _update_table(self, db, model_name, field_names, version):
+        from kadi.events import models
+
+        fields = json.dumps(field_names)
+        row = db.execute(
+            'SELECT fields, version FROM versions WHERE model = ?', [model_name]
+        ).fetchone()
+        if row == (fields, version):
+            return
+        if row is None or row[0] != fields:
+            db.execute(f'DROP TABLE IF EXISTS {model_name}')
+            db.execute(
+                f'CREATE VIRTUAL TABLE {model_name} USING fts5('
+                f'pk UNINDEXED, {", ".join(field_names)}, tokenize="trigram")'
+            )
+
+        model = models.get_event_models()[model_name]
+        events = {
+            pk: tuple(texts) for pk, *texts in model.objects.values_list('pk', *field_names)
+        }
+        indexed = {
+            pk: (rowid, tuple(texts)) for rowid, pk, *texts in db.execute(
+                f'SELECT rowid, pk, {", ".join(field_names)} FROM {model_name}'
+            )
+        }
+        # changed events are removed and added again
+        removed = [
+            (rowid,) for pk, (rowid, texts) in indexed.items() if events.get(pk) != texts
+        ]
+        added = [
+            (pk, *texts) for pk, texts in events.items()
+            if pk not in indexed or indexed[pk][1] != texts
+        ]
+        db.executemany(f'DELETE FROM {model_name} WHERE rowid = ?', removed)
+        db.executemany(
+            f'INSERT INTO {model_name} VALUES ({", ".join("?" * (len(field_names) + 1))})',
+            added,
+        )
+        db.execute(
+            'INSERT OR REPLACE INTO versions VALUES (?, ?, ?)', [model_name, fields, version]
+        )
+        logging.getLogger('kadi_apps').info(
+            f'kadi FTS index: {model_name}: {len(removed)} removed, {len(added)} added'
+        )
+
+    def _attach(self):
+        """Attach the sidecar database to the Django connection of this thread"""
+        from django.db import connection
+
+        connection.ensure_connection()
+        raw_connection = connection.connection
+        databases = [row[1] for row in raw_connection.execute('PRAGMA database_list')]
+        if 'kadi_fts' not in databases:
+            raw_connection.execute('ATTACH DATABASE ? AS kadi_fts', [str(self.path)])
+
+
+def _get_model_name(model):
+    from kadi.events import models
+    return next(
+        (name for name, cls in models.get_event_models().items() if cls is model), None
+    )
+
+
+def _get_match(field_name, text):
+    """Return the FTS5 query for a substring of a field (or any field if field_name is None)"""
+    phrase = '"{}"'.format(text.replace('"', '""'))
+    return phrase if field_name is None else f'{field_name} : {phrase}'
@@ -1,6 +1,15 @@
+import os
 import re
+import math
+import bisect
+import json
+import base64
+import io
+import csv
 import shlex
-from flask import Blueprint, request, url_for
+import functools
+import itertools
+from flask import Blueprint, Response, request, url_for, current_app, appcontext_pushed
 from collections import namedtuple
 # from flask import request
 
@@ -13,7 +22,13 @@ from collections import namedtuple
 from kadi.events import query  # noqa
 from kadi.events import models
 import kadi.events
+import kadi.paths
+from cxotime import CxoTime
 from kadi_apps.rendering import render_template
+from kadi_apps.cache import Cache
+
+from . import fts
+from . import snapshot
 
 
 blueprint = Blueprint(
@@ -23,6 +38,28 @@ blueprint = Blueprint(
 )
 
 
+@blueprint.record_once
+def _init_app(state):
+    state.app.extensions['kadi_cache'] = Cache(state.app.config['KADI_CACHE_MAX_BYTES'])
+    state.app.extensions['kadi_fts'] = fts.FtsIndex(
+        state.app.config['KADI_FTS_DB'], _get_events_db_version
+    ) if state.app.config['KADI_FTS_DB'] else None
+    state.app.extensions['kadi_snapshot'] = None
+    if state.app.config['KADI_EVENTS_SNAPSHOT']:
+        from django.db.backends.signals import connection_created
+
+        events_snapshot = snapshot.EventsSnapshot(kadi.paths.EVENTS_DB_PATH())
+        events_snapshot.start()
+        state.app.extensions['kadi_snapshot'] = events_snapshot
+        connection_created.connect(snapshot.set_query_only)
+        appcontext_pushed.connect(_activate_snapshot, state.app)
+
+
+def _activate_snapshot(app, **kwargs):
+    # every request (and every ska_api batch call) pushes an application context
+    app.extensions['kadi_snapshot'].activate()
+
+
 EVENT_MODELS = {
     em['name']: em for em in sorted([
         {
@@ -41,27 +78,96 @@ def filter_events(
         filter_string_field='start',
         filter_string_op='startswith'
 ):
-    tokens = shlex.split(filter_string)
-    for token in tokens:
+    plan = compile_filter(
+        queryset.model, str(filter_string), filter_string_field, filter_string_op
+    )
+    fts_index = current_app.extensions.get('kadi_fts')
+    for key, val in plan:
+        field_name, _, op = key.partition('__')
+        if (
+            op == 'icontains'
+            and fts_index is not None
+            and fts_index.can_search(queryset.model, field_name, val)
+        ):
+            # free text, see the fts module
+            queryset = fts_index.filter(queryset, field_name, val)
+        else:
+            queryset = queryset.filter(**{key: val})
+    return queryset
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_filter(model, filter_string, filter_string_field, filter_string_op):
+    """Compile a filter string into a tuple of (lookup, value) pairs
+
+    Each token of the filter string is either a comparison (``<field><op><value>``), a date
+    prefix (e.g. ``2013`` or ``2013:001``), or a word to look up in ``filter_string_field``.
+    Comparisons of the start or stop date with a date, and date prefixes, are turned into ranges
+    of the (indexed) tstart or tstop times, instead of comparisons of the date strings.
+
+    Plans are cached, so repeated filter strings are not parsed again.
+    """
+    field_names = {field.name for field in model.get_model_fields()}
+    plan = []
+    for token in shlex.split(filter_string):
         match = re.match(r'(\w+)(=|>|<|>=|<=)([^=><]+)$', token)
         if match:
+            name, op, val = match.groups()
             op = {
                 '=': 'exact',
                 '>=': 'gte',
                 '<=': 'lte',
                 '<': 'lt',
                 '>': 'gt'
-            }[match.group(2)]
-            key = '{}__{}'.format(match.group(1), op)
-            val = match.group(3)
-            queryset = queryset.filter(**{key: val})
-        elif re.match(r'[12]\d{3}', filter_string):
-            key = 'start__startswith'
-            queryset = queryset.filter(**{key: filter_string})
+            }[op]
+            time_name = {'start': 'tstart', 'stop': 'tstop'}.get(name)
+            secs = _get_secs(val) if op != 'exact' and time_name in field_names else None
+            if secs is not None:
+                plan.append((f'{time_name}__{op}', secs))
+            else:
+                plan.append((f'{name}__{op}', val))
+        elif re.match(r'[12]\d{3}', token):
+            secs_range = _get_secs_range(token) if 'tstart' in field_names else None
+            if secs_range is not None:
+                plan.append(('tstart__gte', secs_range[0]))
+                plan.append(('tstart__lt', secs_range[1]))
+            else:
+                plan.append(('start__startswith', token))
         else:
-            key = '{}__{}'.format(filter_string_field, filter_string_op)
-            queryset = queryset.filter(**{key: filter_string})
-    return queryset
+            plan.append((f'{filter_string_field}__{filter_string_op}', token))
+    return tuple(plan)
+
+
+def _get_secs(date):
+    """Return a date (a year is taken as its first day) in CXC seconds, or None if not a date"""
+    if re.fullmatch(r'[12]\d{3}', date):
+        date = f'{date}:001'
+    try:
+        return float(CxoTime(date).secs)
+    except Exception:
+        return None
+
+
+def _get_secs_range(prefix):
+    """Return the time range (CXC seconds) of the dates starting with a year or year:doy prefix
+
+    :returns: tuple or None
+        (start, stop), or None if the prefix is not a year or year:doy.
+    """
+    from datetime import datetime, timedelta
+
+    if re.fullmatch(r'[12]\d{3}', prefix):
+        start, stop = f'{prefix}:001', f'{int(prefix) + 1}:001'
+    elif re.fullmatch(r'[12]\d{3}:\d{3}', prefix):
+        try:
+            day = datetime.strptime(prefix, '%Y:%j')
+        except ValueError:
+            return None
+        start, stop = prefix, (day + timedelta(days=1)).strftime('%Y:%j')
+    else:
+        return None
+    start, stop = _get_secs(start), _get_secs(stop)
+    return None if start is None or stop is None else (start, stop)
 
 
 @blueprint.route("/events/")
@@ -87,7 +193,30 @@ def _get_args(exclude=()):
     return app_kwargs
 
 
+def _cache_page(view):
+    """Cache the HTML rendered by a view
+
+    Pages are keyed by the URL path and query arguments (model, primary key, filter, sort, page
+    or index...) and by the mtime of the events database, so a cached page is served without
+    any query until the database is updated.
+    """
+    @functools.wraps(view)
+    def cached_view(**kwargs):
+        cache = current_app.extensions['kadi_cache']
+        key = (
+            'page', request.path, tuple(sorted(request.args.items(multi=True))),
+            _get_events_db_version(),
+        )
+        page = cache.get(key)
+        if page is None:
+            page = view(**kwargs)
+            cache.set(key, page, size=len(page), ttl=current_app.config['KADI_PAGE_CACHE_TTL'])
+        return page
+    return cached_view
+
+
 @blueprint.route("/events/<string:model_name>/<string:primary_key>")
+@_cache_page
 def event_detail(model_name, primary_key):
     """Return a list of kadi events"""
 
@@ -104,8 +233,6 @@ def event_detail(model_name, primary_key):
     sort = kwargs.get('sort', '')
     index = kwargs.get('index', '')
 
-    # this might be less than ideal, but it is what django kadi does
-    # the whole set is assembled only to get the previous and next event
     kadi_events = getattr(kadi.events, model_name + 's').all()
     kadi_events = filter_events(
         kadi_events,
@@ -114,35 +241,27 @@ def event_detail(model_name, primary_key):
         event_detail_spec.filter_string_op
     )
     if sort:
-        kadi_events = kadi_events.order_by(sort)
+        kadi_events = _order_by(kadi_events, sort, model_pk)
 
-    next_event_url = ''
-    previous_event_url = ''
+    # the previous and next events are looked up in the (cached) primary keys of the whole set
+    pks = _get_neighbor_index(model_name, kadi_events, event_filter, sort, model_pk)
+    pk = event_detail_spec.model._meta.pk.to_python(primary_key)
     if index != '':
-        index = int(index)
-        if index + 1 < kadi_events.count():
-            next_event_url = url_for(
-                'kadi.event_detail', model_name=model_name, filter=event_filter, sort=sort,
-                primary_key=kadi_events[index + 1].pk,
-                index=index + 1
-            )
-        if index > 0:
-            previous_event_url = url_for(
-                'kadi.event_detail', model_name=model_name, filter=event_filter, sort=sort,
-                primary_key=kadi_events[index - 1].pk,
-                index=index - 1
-            )
+        previous_pk, next_pk, index = _get_neighbors(pks, pk, int(index))
+        next_index, previous_index = index + 1, index - 1
     else:
-        next_events = kadi_events.filter(pk__gt=primary_key)
-        next_event_url = url_for(
-            'kadi.event_detail', model_name=model_name, filter=event_filter, sort=sort,
-            primary_key=next_events[0].pk if next_events.count() else '',
-        )
-        prev_events = kadi_events.filter(pk__lt=primary_key)
-        previous_event_url = url_for(
-            'kadi.event_detail', model_name=model_name, filter=event_filter, sort=sort,
-            primary_key=prev_events[-1].pk if prev_events.count() else '',
-        )
+        # without an index, the neighbors are the events with the next and previous keys
+        sorted_pks = _get_sorted_pks(model_name, event_filter, sort, pks)
+        previous_pk, next_pk = _get_key_neighbors(sorted_pks, pk)
+        next_index = previous_index = None
+    next_event_url = url_for(
+        'kadi.event_detail', model_name=model_name, filter=event_filter, sort=sort,
+        primary_key=next_pk, index=next_index,
+    ) if next_pk is not None else ''
+    previous_event_url = url_for(
+        'kadi.event_detail', model_name=model_name, filter=event_filter, sort=sort,
+        primary_key=previous_pk, index=previous_index,
+    ) if previous_pk is not None else ''
 
     event = kadi_events.get(**{model_pk: primary_key})
     formats = {
@@ -175,6 +294,7 @@ def event_detail(model_name, primary_key):
 
 
 @blueprint.route("/events/<string:model_name>/list/")
+@_cache_page
 def event_list(model_name):
     """Return a list of kadi events"""
 
@@ -196,27 +316,23 @@ def event_list(model_name):
     paginate_by = event_list_spec.paginate_by
     filter_string_field = event_list_spec.filter_string_field
     filter_string_op = event_list_spec.filter_string_op
-    reverse_sort = event_list_spec.reverse_sort
 
     kwargs = _get_args()
     event_filter = kwargs.get('filter', '')
     page = kwargs.get('page', 1)
-    sort = kwargs.get('sort', None)
-    if not sort:  # No sort explicitly set in request
-        sort = model._meta.ordering[0]
-        if reverse_sort:
-            sort = '-' + sort
+    sort = _get_sort(event_list_spec, kwargs.get('sort', None))
     sort_field = sort.lstrip('-')
     descending = sort.startswith('-')
 
     kadi_events = getattr(kadi.events, model_name + 's').all()
     kadi_events = filter_events(kadi_events, event_filter, filter_string_field, filter_string_op)
-    if sort:
-        kadi_events = kadi_events.order_by(sort)
 
     # pagination stuff
-    n_rows = len(kadi_events)
+    n_rows = _get_count(model_name, kadi_events, event_filter)
     n_pages = n_rows // paginate_by + (1 if n_rows % paginate_by else 0)
+    rows, first_key, last_key = _get_page_rows(
+        model, kadi_events, field_names, sort, page, paginate_by
+    )
     page_obj = {
         'has_previous': page > 1,
         'has_next': page < n_pages,
@@ -225,12 +341,16 @@ def event_list(model_name):
         'number': page,
         'num_pages': n_pages,
         'start_index': page * paginate_by,
+        'previous_url': url_for(
+            '.event_list', model_name=model_name, page=page - 1, filter=event_filter,
+            sort=sort, before=_encode_cursor(first_key),
+        ) if page > 1 else '',
+        'next_url': url_for(
+            '.event_list', model_name=model_name, page=page + 1, filter=event_filter,
+            sort=sort, after=_encode_cursor(last_key),
+        ) if page < n_pages else '',
     }
 
-    if n_pages > 1:
-        subset = slice((page - 1) * paginate_by, page * paginate_by, 1)
-        kadi_events = kadi_events[subset]
-
     # the table headers. Most of this mess is just for sorting (only the name is not)
     headers = [
         {
@@ -243,7 +363,8 @@ def event_list(model_name):
         for field in model.get_model_fields() if field.name not in ignore_fields
     ]
     for header in headers:
-        args = kwargs.copy()
+        # page cursors are only valid for the current sort
+        args = {key: val for key, val in kwargs.items() if key not in ('after', 'before')}
         if header['field_name'] != sort_field:
             args['sort'] = header['field_name']
             icon = 'asc-desc'
@@ -261,8 +382,8 @@ def event_list(model_name):
     # the table content, the tuple's first entry is an absolute index
     j_start = (page - 1) * paginate_by  # pages start at 1
     event_rows = [
-        (j_start + j, [formats[fn].format(getattr(ke, fn)) for fn in field_names])
-        for j, ke in enumerate(kadi_events)
+        (j_start + j, [formats[fn].format(val) for fn, val in zip(field_names, row)])
+        for j, row in enumerate(rows)
     ]
 
     return render_template(
@@ -279,6 +400,328 @@ def event_list(model_name):
     )
 
 
+def _get_events_db_version():
+    """Return the modification time of the kadi events database
+
+    Cached query results are keyed by it, so they are not used once the database is updated.
+    If events are read from an in-memory snapshot, this is the modification time of the database
+    when the snapshot was taken.
+    """
+    events_snapshot = current_app.extensions.get('kadi_snapshot')
+    version = None if events_snapshot is None else events_snapshot.get_version()
+    if version is not None:
+        return version
+    try:
+        return os.stat(kadi.paths.EVENTS_DB_PATH()).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _get_count(model_name, queryset, event_filter):
+    """Return the number of events matching a filter, using a cached COUNT(*)"""
+    cache = current_app.extensions['kadi_cache']
+    key = ('count', model_name, event_filter, _get_events_db_version())
+    n_rows = cache.get(key)
+    if n_rows is None:
+        n_rows = queryset.count()
+        cache.set(key, n_rows, size=len(repr(key)), ttl=current_app.config['KADI_CACHE_TTL'])
+    return n_rows
+
+
+def _get_neighbor_index(model_name, queryset, event_filter, sort, model_pk):
+    """Return the primary keys of the events of an ordered queryset, in order
+
+    The keys are cached per model, filter and sort, and keyed by the mtime of the events
+    database, so navigating between events does not query the whole set each time.
+
+    :returns: list
+    """
+    cache = current_app.extensions['kadi_cache']
+    key = ('neighbors', model_name, event_filter, sort, _get_events_db_version())
+    pks = cache.get(key)
+    if pks is None:
+        pks = list(queryset.values_list(model_pk, flat=True))
+        size = sum(64 + len(str(pk)) for pk in pks)
+        cache.set(key, pks, size=size, ttl=current_app.config['KADI_CACHE_TTL'])
+    return pks
+
+
+def _get_sorted_pks(model_name, event_filter, sort, pks):
+    """Return a sorted copy of the primary keys returned by _get_neighbor_index
+
+    This is only needed for links without an index, so it is made (and cached) on demand. If the
+    keys are already sorted (e.g. events sorted by start), the keys themselves are returned.
+    """
+    cache = current_app.extensions['kadi_cache']
+    key = ('sorted_pks', model_name, event_filter, sort, _get_events_db_version())
+    sorted_pks = cache.get(key)
+    if sorted_pks is None:
+        sorted_pks = sorted(pks)
+        if sorted_pks == pks:
+            sorted_pks = pks
+            size = 64
+        else:
+            size = sum(64 + len(str(pk)) for pk in pks)
+        cache.set(key, sorted_pks, size=size, ttl=current_app.config['KADI_CACHE_TTL'])
+    return sorted_pks
+
+
+def _get_neighbors(pks, pk, index):
+    """Return the primary keys of the events before and after an event, and the event index
+
+    :param pks: list
+        Primary keys of the events, in order.
+    :param index: int
+        Position of the event in ``pks`` given in the link. If the event is not there (the
+        database changed since the link was made), the index is looked up from the key.
+    :returns: previous key, next key, index
+        The keys are None at the ends of the list.
+    """
+    if not (0 <= index < len(pks) and pks[index] == pk):
+        try:
+            index = pks.index(pk)
+        except ValueError:
+            # the event is not in the set anymore: its neighbors are the events around its old
+            # position, where the event that followed it is now
+            index = min(max(index, 0), len(pks))
+            previous_pk = pks[index - 1] if index > 0 else None
+            next_pk = pks[index] if index < len(pks) else None
+            return previous_pk, next_pk, index
+    previous_pk = pks[index - 1] if index > 0 else None
+    next_pk = pks[index + 1] if index < len(pks) - 1 else None
+    return previous_pk, next_pk, index
+
+
+def _get_key_neighbors(sorted_pks, pk):
+    """Return the primary keys before and after a key (None at the ends)"""
+    ii = bisect.bisect_left(sorted_pks, pk)
+    previous_pk = sorted_pks[ii - 1] if ii > 0 else None
+    ii = bisect.bisect_right(sorted_pks, pk)
+    next_pk = sorted_pks[ii] if ii < len(sorted_pks) else None
+    return previous_pk, next_pk
+
+
+def _order_by(queryset, sort, model_pk):
+    """Order a queryset by the sort field, with the primary key as tie-breaker"""
+    if sort.lstrip('-') == model_pk:
+        return queryset.order_by(sort)
+    return queryset.order_by(sort, ('-' if sort.startswith('-') else '') + model_pk)
+
+
+def _get_page_rows(model, queryset, field_names, sort, page, paginate_by):
+    """Return the values of the displayed fields of the events in a page
+
+    Pages are found by keyset pagination: the 'after' (or 'before') argument of the request is a
+    cursor with the sort value and primary key of the last (or first) event of the previous (or
+    next) page, so the page is an index range scan that costs the same whatever its number.
+    Pages without a valid cursor (e.g. bookmarked links), and sorts on fields that can be null
+    (which cannot be compared), fall back to OFFSET.
+
+    Only the displayed fields (and the sort field and primary key, for the cursors) are fetched.
+
+    :returns: list, tuple, tuple
+        The rows (lists of values of ``field_names``), and the keys (sort value, primary key) of
+        the first and last rows.
+    """
+    from django.db.models import Q
+
+    model_pk = model._meta.pk.name
+    sort_field = sort.lstrip('-')
+    descending = sort.startswith('-')
+    names = list(dict.fromkeys(field_names + [sort_field, model_pk]))
+    after = _decode_cursor(request.args.get('after'))
+    before = _decode_cursor(request.args.get('before'))
+    if model._meta.get_field(sort_field).null:
+        after = before = None
+
+    queryset = _order_by(queryset, sort, model_pk)
+    if after is not None or before is not None:
+        # rows after the cursor in the sort order (before it, in reverse order, for 'before')
+        value, pk = after or before
+        op = 'lt' if descending == (after is not None) else 'gt'
+        if before is not None:
+            queryset = queryset.reverse()
+        if sort_field == model_pk:
+            queryset = queryset.filter(**{f'{model_pk}__{op}': pk})
+        else:
+            queryset = queryset.filter(
+                Q(**{f'{sort_field}__{op}': value})
+                | Q(**{sort_field: value, f'{model_pk}__{op}': pk})
+            )
+        queryset = queryset[:paginate_by]
+    else:
+        queryset = queryset[(page - 1) * paginate_by:page * paginate_by]
+
+    relations = [name for name in names if model._meta.get_field(name).is_relation]
+    if relations:
+        # related objects are displayed as such, not by their key
+        rows = [
+            [getattr(event, name) for name in names]
+            for event in queryset.select_related(*relations)
+        ]
+    else:
+        rows = [list(row) for row in queryset.values_list(*names)]
+    if before is not None:
+        rows = rows[::-1]
+
+    i_sort, i_pk = names.index(sort_field), names.index(model_pk)
+    first_key = _get_key(rows[0], i_sort, i_pk) if rows else None
+    last_key = _get_key(rows[-1], i_sort, i_pk) if rows else None
+    return [row[:len(field_names)] for row in rows], first_key, last_key
+
+
+def _get_key(row, i_sort, i_pk):
+    return [getattr(row[i], 'pk', row[i]) for i in (i_sort, i_pk)]
+
+
+def _encode_cursor(key):
+    """Return the page cursor of a key (None for no key, which url_for leaves out)"""
+    if key is None:
+        return None
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+def _decode_cursor(cursor):
+    """Return the (sort value, primary key) in a page cursor, or None if it is not valid"""
+    if not cursor:
+        return None
+    try:
+        value, pk = json.loads(base64.urlsafe_b64decode(cursor))
+    except Exception:
+        return None
+    return value, pk
+
+
+@blueprint.route("/events/<string:model_name>/list.json")
+def event_list_json(model_name):
+    """Return all the kadi events matching a filter as a JSON list of objects"""
+    return _export_events(model_name, 'json', 'application/json', _iter_json)
+
+
+@blueprint.route("/events/<string:model_name>/list.csv")
+def event_list_csv(model_name):
+    """Return all the kadi events matching a filter as CSV"""
+    return _export_events(model_name, 'csv', 'text/csv', _iter_csv)
+
+
+@blueprint.route("/events/<string:model_name>/search.json")
+def event_search_json(model_name):
+    """Return the kadi events matching a text, best matches first, as a JSON list of objects
+
+    Matches are found and ranked with the full-text index (see the fts module). Arguments are
+    ``text``, ``field`` (the text field to search, default is all the indexed fields) and
+    ``limit`` (the maximum number of events, default is 100).
+    """
+    fts_index = current_app.extensions.get('kadi_fts')
+    if fts_index is None or model_name not in fts.FTS_FIELDS:
+        return {'ok': False, 'error': f'no full-text search for {model_name} events'}, 404
+
+    text = request.args.get('text', '')
+    field_name = request.args.get('field')
+    limit = request.args.get('limit', 100, type=int)
+    if field_name is not None and field_name not in fts.FTS_FIELDS[model_name]:
+        return {'ok': False, 'error': f'{field_name} is not a text field of {model_name}'}, 400
+    if len(text) < fts.MIN_LENGTH:
+        return {'ok': False, 'error': f'text must have at least {fts.MIN_LENGTH} characters'}, 400
+    if limit < 1:
+        return {'ok': False, 'error': 'limit must be a positive integer'}, 400
+
+    try:
+        pks = fts_index.search(model_name, text, field_name=field_name, limit=limit)
+    except Exception as e:
+        return {'ok': False, 'error': f'full-text search failed ({type(e).__name__}: {e})'}, 503
+
+    model = models.get_event_models()[model_name]
+    names = [field.name for field in model.get_model_fields()]
+    i_pk = names.index(model._meta.pk.name)
+    rows = {row[i_pk]: row for row in model.objects.filter(pk__in=pks).values_list(*names)}
+    rows = [rows[pk] for pk in pks if pk in rows]
+    return Response(''.join(_iter_json(names, [rows])), mimetype='application/json')
+
+
+def _export_events(model_name, extension, mimetype, iter_chunks):
+    """Stream all the events of a model matching the filter and sort of the request
+
+    The filter and sort are the same as in the event list. Events are read from the database
+    with a cursor, KADI_EXPORT_CHUNK_ROWS rows at a time, so memory use does not grow with the
+    number of events.
+    """
+    assert model_name in EVENT_LIST, f'Unknown model {model_name}'
+    event_list_spec = EVENT_LIST[model_name]
+    model = event_list_spec.model
+
+    kwargs = _get_args()
+    sort = _get_sort(event_list_spec, kwargs.get('sort', None))
+    kadi_events = getattr(kadi.events, model_name + 's').all()
+    kadi_events = filter_events(
+        kadi_events,
+        kwargs.get('filter', ''),
+        event_list_spec.filter_string_field,
+        event_list_spec.filter_string_op
+    )
+    kadi_events = _order_by(kadi_events, sort, model._meta.pk.name)
+
+    names = [field.name for field in model.get_model_fields()]
+    chunk_rows = current_app.config['KADI_EXPORT_CHUNK_ROWS']
+    rows = kadi_events.values_list(*names).iterator(chunk_size=chunk_rows)
+    return Response(
+        iter_chunks(names, _iter_blocks(rows, chunk_rows)),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'inline; filename="{model_name}.{extension}"'},
+    )
+
+
+def _iter_blocks(rows, n_rows):
+    """Yield lists of (at most) ``n_rows`` rows"""
+    rows = iter(rows)
+    while block := list(itertools.islice(rows, n_rows)):
+        yield block
+
+
+def _iter_json(names, blocks):
+    """Yield a JSON list of objects (one per row) in chunks
+
+    NaN and infinite values (e.g. missing floats) are not valid JSON, they are replaced by null.
+    """
+    yield '['
+    sep = ''
+    for block in blocks:
+        yield sep + ', '.join(
+            json.dumps({name: _json_value(val) for name, val in zip(names, row)}, allow_nan=False)
+            for row in block
+        )
+        sep = ', '
+    yield ']'
+
+
+def _json_value(val):
+    if isinstance(val, float) and not math.isfinite(val):
+        return None
+    return val
+
+
+def _iter_csv(names, blocks):
+    """Yield CSV lines (with a header line) in chunks"""
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(names)
+    for block in blocks:
+        writer.writerows(block)
+        yield out.getvalue()
+        out.seek(0)
+        out.truncate()
+    yield out.getvalue()
+
+
+def _get_sort(event_list_spec, sort):
+    """Return the sort of an event list, which is the model ordering if not given"""
+    if not sort:  # No sort explicitly set in request
+        sort = event_list_spec.model._meta.ordering[0]
+        if event_list_spec.reverse_sort:
+            sort = '-' + sort
+    return sort
+
+
 FILTER_HELP = """
 <strong>Filtering help</strong>
 <p><p>
@@ -0,0 +1,129 @@
+"""
+In-memory snapshot of the kadi events database.
+
+The events browser reads the kadi events database through Django, so every query goes to the
+SQLite file, which can be on a slow (network) disk and is locked while the updater writes to it.
+With this module, each worker copies the database to an in-memory SQLite database (with the
+SQLite backup API) and points the Django connections of its threads at the copy, so queries never
+touch the file.
+
+The copy is a shared-cache in-memory database with a unique name, which is kept alive by a
+connection held by the snapshot. When the modification time of the events database changes, a
+new copy is made in a background thread, and it replaces the previous one once it is complete.
+Until then, readers keep using the previous copy. Django connections switch to the new copy the
+next time their thread pushes a Flask application context (see ``activate``).
+"""
+
+import os
+import logging
+import sqlite3
+import threading
+import itertools
+from pathlib import Path
+from contextlib import closing
+
+
+class EventsSnapshot:
+    """
+    In-memory copy of the kadi events database.
+
+    :param path: str or Path
+        Path of the kadi events database.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.name = None
+        self.version = None
+        self._db = None
+        self._thread = None
+        self._failed_version = None
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Load the snapshot in a background thread"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return self._thread
+            self._thread = threading.Thread(target=self._load, daemon=True, name='kadi_snapshot')
+            self._thread.start()
+            return self._thread
+
+    def load(self):
+        """Copy the events database to a new in-memory database and switch to it"""
+        version = _get_version(self.path)
+        name = f'file:kadi_events_{os.getpid()}_{next(self._ids)}?mode=memory&cache=shared'
+        db = sqlite3.connect(name, uri=True, check_same_thread=False)
+        try:
+            source_uri = f'{self.path.resolve().as_uri()}?mode=ro'
+            with closing(sqlite3.connect(source_uri, uri=True)) as source:
+                source.backup(db)
+        except Exception:
+            db.close()
+            raise
+        with self._lock:
+            old_db = self._db
+            self._db, self.name, self.version = db, name, version
+        # the previous copy is freed once the connections that still use it are closed
+        if old_db is not None:
+            old_db.close()
+        logging.getLogger('kadi_apps').info(f'kadi events snapshot: loaded {self.path}')
+
+    def activate(self):
+        """Point the Django connection of this thread at the current snapshot
+
+        If the events database changed since the snapshot was taken, a new snapshot is loaded in
+        the background, and this thread keeps using the current one.
+        """
+        from django.db import connection
+        from django.db.backends.base.base import BaseDatabaseWrapper
+
+        version = _get_version(self.path)
+        if version not in (self.version, self._failed_version):
+            self.start()
+        with self._lock:
+            name, version = self.name, self.version
+        if name is None or getattr(connection, 'kadi_snapshot', None) == (name, version):
+            return
+        # Django ignores close() on in-memory databases (closing the last connection to one
+        # destroys it), but this one is kept alive by the snapshot.
+        BaseDatabaseWrapper.close(connection)
+        # settings_dict is shared by the connections of all threads
+        connection.settings_dict = {**connection.settings_dict, 'NAME': name}
+        connection.kadi_snapshot = (name, version)
+
+    def get_version(self):
+        """Return the version of the snapshot used by this thread
+
+        :returns: int
+            Modification time (ns) of the events database when the snapshot was taken, or None
+            if the Django connection of this thread is not using a snapshot.
+        """
+        from django.db import connection
+        snapshot = getattr(connection, 'kadi_snapshot', None)
+        return None if snapshot is None else snapshot[1]
+
+    def _load(self):
+        version = _get_version(self.path)
+        try:
+            self.load()
+        except Exception as e:
+            logging.getLogger('kadi_apps').warning(
+                f'kadi events snapshot: failed to load ({type(e).__name__}: {e})'
+            )
+            # do not try again until the database changes
+            self._failed_version = version
+
+
+def set_query_only(sender, connection, **kwargs):
+    """Make the Django connections to a snapshot read-only (connection_created receiver)"""
+    if getattr(connection, 'kadi_snapshot', None) is not None:
+        connection.connection.execute('PRAGMA query_only = ON')
+
+
+def _get_version(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
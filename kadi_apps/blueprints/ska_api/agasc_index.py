@@ -0,0 +1,201 @@
+"""
+In-memory spatial index of a magnitude-limited subset of the AGASC.
+
+The index is a KD-tree on the unit vectors of the catalog positions of the AGASC stars brighter
+than a given magnitude (plus all stars in the AGASC supplement, whose magnitudes can change). It
+serves ``agasc.get_agasc_cone`` calls with a ``max_mag`` argument (a ska_api extension) and a
+radius below a given limit. Candidates are selected from the tree with a search radius padded by
+the maximum proper motion in the subset, and they are then processed with the same functions that
+``agasc.get_agasc_cone`` uses (proper motion correction, COLOR1 fix and supplement), so the
+results are the same, in the same order (sorted by catalog declination).
+
+The index is loaded in a background thread, and it is checked against ``agasc.get_agasc_cone``
+before it is used. Until then (or if the check fails), calls go to ``agasc.get_agasc_cone``.
+"""
+
+import logging
+import threading
+
+import numpy as np
+
+
+# get_agasc_cone arguments that the index can handle
+INDEX_KWARGS = {'ra', 'dec', 'radius', 'date', 'pm_filter', 'fix_color1', 'use_supplement'}
+
+
+class AgascIndex:
+    """
+    KD-tree index of the AGASC stars brighter than ``max_mag``.
+
+    :param max_mag: float
+        Magnitude limit of the stars in the index.
+    :param max_radius: float
+        Maximum cone radius (degrees) served from the index.
+    :param agasc_file: str
+        AGASC file. Default is the default file of ``agasc.get_agasc_cone``.
+    """
+
+    def __init__(self, max_mag, max_radius, agasc_file=None):
+        self.max_mag = max_mag
+        self.max_radius = max_radius
+        self.agasc_file = agasc_file
+        self.ready = False
+        self._stars = None
+        self._tree = None
+        self._max_pm = 0.
+        self._epochs = (2000., 2000.)
+
+    def start(self):
+        """Load and check the index in a background thread"""
+        thread = threading.Thread(target=self._load_and_check, daemon=True, name='agasc_index')
+        thread.start()
+        return thread
+
+    def can_serve(self, max_mag=None, **kwargs):
+        """Check whether a get_agasc_cone call can be served from the index"""
+        return (
+            self.ready
+            and max_mag is not None
+            and max_mag <= self.max_mag
+            and 'ra' in kwargs
+            and 'dec' in kwargs
+            and kwargs.get('radius', 1.5) <= self.max_radius
+            and set(kwargs) <= INDEX_KWARGS
+        )
+
+    def get_agasc_cone(
+        self, ra, dec, radius=1.5, date=None, pm_filter=True, fix_color1=True,
+        use_supplement=None, max_mag=None,
+    ):
+        """Same as ``agasc.get_agasc_cone``, returning only stars with MAG_ACA <= max_mag"""
+        from astropy.table import Table
+        from cxotime import CxoTime
+        from agasc.agasc import (
+            add_pmcorr_columns, update_color1_column, update_from_supplement, sphere_dist,
+        )
+
+        # stars can move by up to max_pm (mas/yr) times the years since their epoch
+        year = CxoTime(date).decimalyear
+        years = max(abs(year - self._epochs[0]), abs(year - self._epochs[1]))
+        pad = self._max_pm * years / 3.6e6 + 1e-6 if pm_filter else 1e-6
+        idx = self._tree.query_ball_point(_unit_vector(ra, dec), _chord(radius + pad))
+        stars = self._stars[np.asarray(idx, dtype=int)]
+        # the order of agasc.get_agasc_cone (and of the dec-sorted AGASC files)
+        stars.sort(order='DEC')
+        stars = Table(stars)
+
+        add_pmcorr_columns(stars, date)
+        if pm_filter:
+            dists = sphere_dist(ra, dec, stars['RA_PMCORR'], stars['DEC_PMCORR'])
+        else:
+            dists = sphere_dist(ra, dec, stars['RA'], stars['DEC'])
+        stars = stars[dists <= radius]
+        if fix_color1:
+            update_color1_column(stars)
+        update_from_supplement(stars, use_supplement)
+        return stars[stars['MAG_ACA'] <= max_mag]
+
+    def load(self):
+        """Read the stars in the index from the AGASC file and build the KD-tree"""
+        import tables
+        import agasc
+        from scipy.spatial import cKDTree
+
+        agasc_file = self.agasc_file or agasc.get_agasc_filename()
+        try:
+            supplement_ids = np.array(agasc.get_supplement_table('mags')['agasc_id'])
+        except Exception:
+            supplement_ids = np.array([], dtype=int)
+
+        chunks = []
+        with tables.open_file(agasc_file) as h5:
+            data = h5.root.data
+            chunk_size = 1_000_000
+            for i0 in range(0, data.nrows, chunk_size):
+                chunk = data.read(i0, i0 + chunk_size)
+                ok = (
+                    (chunk['MAG_ACA'] <= self.max_mag)
+                    | np.isin(chunk['AGASC_ID'], supplement_ids)
+                )
+                chunks.append(chunk[ok])
+        stars = np.concatenate(chunks)
+
+        has_pm = (stars['PM_RA'] != -9999) & (stars['PM_DEC'] != -9999)
+        if np.any(has_pm):
+            pm = np.hypot(stars['PM_RA'][has_pm], stars['PM_DEC'][has_pm])
+            epochs = stars['EPOCH'][has_pm]
+            self._max_pm = float(pm.max())
+            self._epochs = (float(epochs.min()), float(epochs.max()))
+        self._stars = stars
+        self._tree = cKDTree(_unit_vector(stars['RA'], stars['DEC']).T)
+        logging.getLogger('kadi_apps').info(
+            f'AGASC index: loaded {len(stars)} stars from {agasc_file}'
+        )
+
+    def check(self, n_cones=10, seed=0):
+        """Compare the results of the index with agasc.get_agasc_cone
+
+        :returns: bool
+        """
+        import agasc
+
+        rng = np.random.default_rng(seed)
+        for _ in range(n_cones):
+            ra = rng.uniform(0, 360)
+            dec = np.degrees(np.arcsin(rng.uniform(-1, 1)))
+            radius = rng.uniform(0.1, self.max_radius)
+            date = f'{rng.integers(2000, 2030)}:001'
+            stars = self.get_agasc_cone(ra, dec, radius, date=date, max_mag=self.max_mag)
+            expected = agasc.get_agasc_cone(ra, dec, radius, date=date)
+            expected = expected[expected['MAG_ACA'] <= self.max_mag]
+            if not _same_stars(stars, expected):
+                logging.getLogger('kadi_apps').warning(
+                    f'AGASC index: results differ from agasc.get_agasc_cone '
+                    f'({ra=:.3f} {dec=:.3f} {radius=:.3f} {date=})'
+                )
+                return False
+        return True
+
+    def _load_and_check(self):
+        logger = logging.getLogger('kadi_apps')
+        try:
+            self.load()
+            self.ready = self.check()
+        except Exception as e:
+            logger.warning(f'AGASC index: failed to load ({type(e).__name__}: {e})')
+            self.ready = False
+        if not self.ready:
+            self._stars = self._tree = None
+            logger.warning('AGASC index: disabled, calls will use agasc.get_agasc_cone')
+
+
+def get_agasc_cone(agasc_index, func, max_mag, **kwargs):
+    """Call ``agasc.get_agasc_cone`` and keep the stars with MAG_ACA <= max_mag
+
+    The call is served from the index if possible.
+    """
+    if agasc_index is not None and agasc_index.can_serve(max_mag=max_mag, **kwargs):
+        return agasc_index.get_agasc_cone(max_mag=max_mag, **kwargs)
+    stars = func(**kwargs)
+    return stars[stars['MAG_ACA'] <= max_mag]
+
+
+def _unit_vector(ra, dec):
+    ra = np.radians(ra)
+    dec = np.radians(dec)
+    return np.array([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)])
+
+
+def _chord(radius):
+    """Distance between two unit vectors separated by ``radius`` degrees"""
+    return 2 * np.sin(np.radians(min(radius, 180)) / 2)
+
+
+def _same_stars(stars, expected):
+    """Check that two tables have the same stars, in the same order"""
+    if len(stars) != len(expected) or stars.colnames != expected.colnames:
+        return False
+    return all(
+        np.array_equal(stars[name], expected[name], equal_nan=stars[name].dtype.kind == 'f')
+        for name in stars.colnames
+    )
@@ -1,8 +1,28 @@
-from flask import Blueprint
-from flask import request
+from flask import Blueprint, Response
+from flask import request, current_app, send_file, url_for
 
+import time
 import logging
 import json
+import threading
+import functools
+import multiprocessing
+from fnmatch import fnmatch
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import werkzeug
+
+from kadi_apps.cache import Cache, SingleFlight
+
+from . import formats
+from . import where as where_expr
+from .jobs import JobStore, run_job, PENDING
+from . import limits
+from .timing import Timing
+from .tiles import TileCache
+from .versions import DataVersions
+from . import agasc_index
 
 
 APPS = {
@@ -16,41 +36,768 @@ APPS = {
     ('kadi', 'commands', 'states'): ['get_states']
 }
 
+# Limits on the execution of API functions, keyed by function name glob (the first match is used).
+# Each function has its own limits:
+# - max_concurrent: number of calls running at the same time (per worker).
+# - max_queue: number of calls waiting for a free slot. Further calls get a 503 response.
+# - timeout: seconds (including the time waiting for a slot) before the caller gets a 504 response.
+# Functions that do not match any glob are not limited.
+APP_LIMITS = {
+    'agasc.get_agasc_cone': {'max_concurrent': 2, 'max_queue': 4, 'timeout': 120},
+    'agasc.get_stars': {'max_concurrent': 4, 'max_queue': 8, 'timeout': 120},
+    'kadi.commands.states.get_states': {'max_concurrent': 4, 'max_queue': 8, 'timeout': 300},
+    'kadi.commands.get_*': {'max_concurrent': 4, 'max_queue': 8, 'timeout': 300},
+}
+
+# Functions resolved from APPS, keyed by URL path. This is filled at startup if the
+# SKA_API_WARM_UP setting is True, and as functions are requested otherwise.
+REGISTRY = {}
+
+# Streaming output formats and their mimetypes. Tables are streamed in blocks of
+# STREAM_CHUNK_ROWS rows, so memory use does not grow with the size of the result.
+STREAM_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'json-stream': 'application/json',
+}
+STREAM_CHUNK_ROWS = 10000
+
 
 blueprint = Blueprint('ska_api', __name__, template_folder='templates')
 
 
+@blueprint.record_once
+def _init_app(state):
+    state.app.extensions['ska_api_cache'] = Cache(state.app.config['SKA_API_CACHE_MAX_BYTES'])
+    state.app.extensions['ska_api_single_flight'] = SingleFlight()
+    state.app.extensions['ska_api_tiles'] = TileCache(
+        state.app.extensions['ska_api_cache'],
+        tile_size=state.app.config['SKA_API_TILE_SIZE'],
+        max_tiles=state.app.config['SKA_API_TILE_MAX_TILES'],
+        ttl=state.app.config['SKA_API_TILE_TTL'],
+        recent=state.app.config['SKA_API_TILE_RECENT'],
+    ) if state.app.config['SKA_API_TILE_SIZE'] else None
+    state.app.extensions['ska_api_versions'] = DataVersions(
+        state.app.config['SKA_API_DATA_VERSION_TTL']
+    )
+    state.app.extensions['ska_api_batch_executor'] = ThreadPoolExecutor(
+        max_workers=state.app.config['SKA_API_BATCH_MAX_WORKERS'],
+        thread_name_prefix='ska_api_batch',
+    )
+    state.app.extensions['ska_api_jobs'] = JobStore(
+        state.app.config['SKA_API_JOBS_DIR'], state.app.config['SKA_API_JOBS_TTL']
+    )
+    state.app.extensions['ska_api_jobs_executor'] = _get_jobs_executor(state.app.config)
+    state.app.extensions['ska_api_limiters'] = {}
+    state.app.extensions['ska_api_agasc_index'] = None
+    if state.app.config['SKA_API_AGASC_INDEX']:
+        index = agasc_index.AgascIndex(
+            max_mag=state.app.config['SKA_API_AGASC_INDEX_MAX_MAG'],
+            max_radius=state.app.config['SKA_API_AGASC_INDEX_MAX_RADIUS'],
+        )
+        index.start()
+        state.app.extensions['ska_api_agasc_index'] = index
+    if state.app.config['SKA_API_WARM_UP']:
+        build_registry()
+
+
 class NotFound(Exception):
     pass
 
 
-@blueprint.route("/<path:path>")
+class BadRequest(Exception):
+    pass
+
+
+class ServiceUnavailable(Exception):
+    pass
+
+
+class GatewayTimeout(Exception):
+    pass
+
+
+@blueprint.route("/_cache")
+def cache_stats():
+    stats = current_app.extensions['ska_api_cache'].stats()
+    stats['coalesced'] = current_app.extensions['ska_api_single_flight'].coalesced
+    return stats, 200
+
+
+@blueprint.route("/_limits")
+def limits_stats():
+    return {
+        func_name: limiter.stats()
+        for func_name, limiter in sorted(current_app.extensions['ska_api_limiters'].items())
+    }, 200
+
+
+@blueprint.route("/_functions")
+def functions():
+    """List the functions in the registry"""
+    return {
+        'functions': {
+            path: {
+                'name': f'{getattr(func, "__module__", "")}.{getattr(func, "__qualname__", "")}',
+                'doc': (func.__doc__ or '').strip().split('\n')[0],
+            }
+            for path, func in sorted(REGISTRY.items())
+        }
+    }, 200
+
+
+@blueprint.route("/<path:path>", methods=['GET', 'POST'])
 def api(path):
     logger = logging.getLogger('kadi_apps')
+    timing = Timing()
     try:
-        app_func = _get_function(path)
-        app_kwargs = _get_args(exclude=[])
-        table_format = app_kwargs.pop('table_format', None)
-        strict_encode = app_kwargs.pop('strict_encode', True)
+        with timing.phase('resolve'):
+            app_func = _get_function(path)
+        with timing.phase('args'):
+            app_kwargs = _get_args(exclude=[])
+            table_format = app_kwargs.pop('table_format', None)
+            strict_encode = app_kwargs.pop('strict_encode', True)
+            run_async = app_kwargs.pop('async', False)
+            output_format = _get_output_format(app_kwargs)
+            columns, where = _get_selection(app_kwargs)
+            # page tokens are bound to everything that changes which rows the call returns
+            query = (path, app_kwargs, table_format, columns, where)
+            page = _get_paging(app_kwargs, query)
 
-        logger.info(f'{path.replace("/", ".")}(')
-        logger.info(f'    **{app_kwargs}')
+        func_name = path.replace("/", ".")
+        logger.info(f'{func_name}(')
+        logger.info(f'    **{_abbreviate_kwargs(app_kwargs)}')
         logger.info(f')')
 
-        dumper = APIEncoder(table_format=table_format, strict_encode=strict_encode)
-        output = app_func(**app_kwargs)
-        output = dumper.encode(output).encode('utf-8')
-        return output, 200
+        if run_async:
+            if page is not None:
+                raise BadRequest('paging is not available for async calls')
+            options = {
+                'table_format': table_format,
+                'strict_encode': strict_encode,
+                'output_format': output_format,
+                'columns': columns,
+                'where': where,
+            }
+            return _submit_job(path, app_kwargs, options)
+
+        headers = {'Vary': 'Accept'}
+        if request.method in ('GET', 'HEAD'):
+            etag = _get_etag(
+                func_name, app_kwargs, table_format, strict_encode, output_format, page, columns,
+                where,
+            )
+            if etag is not None:
+                # clients must revalidate, the ETag changes as soon as the data changes
+                headers['ETag'] = werkzeug.http.quote_etag(etag, weak=True)
+                headers['Cache-Control'] = 'no-cache'
+                if request.if_none_match.contains_weak(etag):
+                    logger.info(f'{func_name} not modified')
+                    return Response(status=304, headers=headers)
+
+        if output_format in STREAM_FORMATS:
+            # streamed responses are not cached, that would defeat the purpose of streaming
+            dumper = APIEncoder(
+                table_format=table_format, strict_encode=strict_encode, timing=timing
+            )
+            with timing.phase('call'):
+                output, total = _get_output(func_name, app_func, app_kwargs, page, columns, where)
+            timing.info.update(_get_shape(output))
+            if page is not None:
+                headers.update(_get_page_headers(query, page, total))
+            if output_format == 'ndjson':
+                chunks = dumper.iterencode_ndjson(output)
+            else:
+                chunks = dumper.iterencode_chunks(output)
+            # the header only has the phases before streaming, the log line has them all
+            headers['Server-Timing'] = timing.header()
+            return Response(
+                _timed_stream(func_name, timing, chunks),
+                mimetype=STREAM_FORMATS[output_format],
+                headers=headers,
+            )
+
+        output, info = _call(
+            func_name, app_func, app_kwargs, table_format, strict_encode, output_format,
+            page, columns, where, timing=timing,
+        )
+        if page is not None:
+            headers.update(_get_page_headers(query, page, info['total']))
+        timing.info['bytes'] = len(output)
+        headers['Server-Timing'] = timing.header()
+        logger.info(f'{func_name} timing: {timing}')
+        mimetype = formats.FORMATS.get(output_format, 'application/json')
+        return Response(output, mimetype=mimetype, headers=headers)
     except NotFound as e:
         logger.info(f'NotFound: {e}')
         return {'ok': False, 'error': str(e)}, 404
+    except BadRequest as e:
+        logger.info(f'BadRequest: {e}')
+        return {'ok': False, 'error': str(e)}, 400
+    except ServiceUnavailable as e:
+        logger.info(f'ServiceUnavailable: {e}')
+        return {'ok': False, 'error': str(e)}, 503
+    except GatewayTimeout as e:
+        logger.info(f'GatewayTimeout: {e}')
+        return {'ok': False, 'error': str(e)}, 504
     except Exception as e:
         logger.info(f'Exception: {e}')
         return {'ok': False, 'error': str(e)}, 500
 
 
+@blueprint.route("/_batch", methods=['POST'])
+def batch():
+    """Run several API calls concurrently
+
+    The request body is a JSON list of calls, each one of the form ``{"path": <path>, "kwargs":
+    {<arg>: <val>, ...}}``. The response is a JSON list with one entry per call, either
+    ``{"ok": true, "result": <result>}`` or ``{"ok": false, "error": <message>, "status": <code>}``.
+    """
+    logger = logging.getLogger('kadi_apps')
+    try:
+        calls = request.get_json(force=True)
+        if not isinstance(calls, list) or not all(
+            isinstance(call, dict) and isinstance(call.get('path'), str)
+            and isinstance(call.get('kwargs', {}), dict)
+            for call in calls
+        ):
+            raise BadRequest('batch request must be a list of {"path": str, "kwargs": dict}')
+        max_calls = current_app.config['SKA_API_BATCH_MAX_CALLS']
+        if len(calls) > max_calls:
+            raise BadRequest(f'batch request has {len(calls)} calls (max is {max_calls})')
+    except (BadRequest, werkzeug.exceptions.BadRequest) as e:
+        logger.info(f'BadRequest: {e}')
+        return {'ok': False, 'error': str(e)}, 400
+
+    logger.info(f'batch of {len(calls)} calls')
+    app = current_app._get_current_object()
+
+    def run(call):
+        with app.app_context():
+            return _batch_call(call['path'], dict(call.get('kwargs', {})))
+
+    executor = current_app.extensions['ska_api_batch_executor']
+    results = list(executor.map(run, calls))
+    return Response(b'[' + b', '.join(results) + b']', mimetype='application/json')
+
+
+def _timed_stream(func_name, timing, chunks):
+    """Yield the encoded chunks of a streamed response, timing the encoding
+
+    The timing is logged once the whole response has been sent.
+    """
+    chunks = iter(chunks)
+    n_bytes = 0
+    while True:
+        with timing.phase('encode'):
+            chunk = next(chunks, None)
+        if chunk is None:
+            break
+        chunk = chunk.encode('utf-8')
+        n_bytes += len(chunk)
+        yield chunk
+    timing.info['bytes'] = n_bytes
+    logging.getLogger('kadi_apps').info(f'{func_name} timing: {timing}')
+
+
+def _get_jobs_executor(config):
+    # processes are started when the first job is submitted. They are spawned (not forked) so
+    # they do not inherit the threads of the Flask worker.
+    return ProcessPoolExecutor(
+        max_workers=config['SKA_API_JOBS_MAX_WORKERS'],
+        mp_context=multiprocessing.get_context('spawn'),
+    )
+
+
+def _submit_job(path, app_kwargs, options):
+    """Submit an API call to the job process pool and return the 202 response with the job id"""
+    logger = logging.getLogger('kadi_apps')
+    store = current_app.extensions['ska_api_jobs']
+    store.expire()
+    job_id = store.create(path, app_kwargs)
+    args = (run_job, store.root, store.ttl, job_id, path, app_kwargs, options)
+    try:
+        try:
+            future = current_app.extensions['ska_api_jobs_executor'].submit(*args)
+        except BrokenProcessPool:
+            # a pool process died (e.g. it was killed when out of memory), and the pool does not
+            # accept jobs anymore. It is replaced by a new one.
+            logger.warning('job process pool is broken, starting a new one')
+            current_app.extensions['ska_api_jobs_executor'].shutdown(wait=False)
+            current_app.extensions['ska_api_jobs_executor'] = _get_jobs_executor(current_app.config)
+            future = current_app.extensions['ska_api_jobs_executor'].submit(*args)
+    except Exception as e:
+        error = f'job could not be submitted ({type(e).__name__}: {e})'
+        logger.warning(f'job {job_id}: {error}')
+        store.update(job_id, status='error', finished=time.time(), error=error, error_status=500)
+        return {'ok': False, 'error': error, 'job_id': job_id}, 500
+    future.add_done_callback(functools.partial(_job_done, store, job_id))
+    logger.info(f'submitted job {job_id}')
+    info = _get_job_info(store.get_status(job_id))
+    return info, 202, {'Location': info['status_url']}
+
+
+def _job_done(store, job_id, future):
+    """Mark a job as failed if it did not run
+
+    run_job stores its own errors, so this only happens if the job was cancelled or the process
+    pool broke (e.g. a pool process was killed) before the job finished.
+    """
+    if future.cancelled():
+        error = 'job was cancelled'
+    elif future.exception() is not None:
+        error = f'job did not run: {type(future.exception()).__name__}'
+    else:
+        return
+    status = store.get_status(job_id)
+    if status is not None and status['status'] in PENDING:
+        store.update(job_id, status='error', finished=time.time(), error=error, error_status=500)
+
+
+@blueprint.route("/_jobs/<job_id>")
+def job_status(job_id):
+    """Return the status of an async job"""
+    status = current_app.extensions['ska_api_jobs'].get_status(job_id)
+    if status is None:
+        return {'ok': False, 'error': f'job {job_id} not found'}, 404
+    return _get_job_info(status), 200
+
+
+@blueprint.route("/_jobs/<job_id>/result")
+def job_result(job_id):
+    """Return the encoded result of an async job"""
+    store = current_app.extensions['ska_api_jobs']
+    status = store.get_status(job_id)
+    if status is None:
+        return {'ok': False, 'error': f'job {job_id} not found'}, 404
+    if status['status'] == 'error':
+        return {'ok': False, 'error': status['error']}, status['error_status']
+    if status['status'] != 'done':
+        return {'ok': False, 'error': f'job {job_id} is {status["status"]}'}, 409
+    return send_file(store.result_path(job_id), mimetype=status['mimetype'])
+
+
+def _get_job_info(status):
+    info = {
+        'ok': True,
+        'job_id': status['job_id'],
+        'status': status['status'],
+        'status_url': url_for('ska_api.job_status', job_id=status['job_id'], _external=True),
+    }
+    for key in ['created', 'started', 'finished', 'expires', 'size', 'error']:
+        if key in status:
+            info[key] = status[key]
+    if status['status'] == 'done':
+        info['result_url'] = url_for(
+            'ska_api.job_result', job_id=status['job_id'], _external=True
+        )
+    return info
+
+
+def _batch_call(path, app_kwargs):
+    logger = logging.getLogger('kadi_apps')
+    try:
+        app_func = _get_function(path)
+        table_format = app_kwargs.pop('table_format', None)
+        strict_encode = app_kwargs.pop('strict_encode', True)
+        func_name = path.replace("/", ".")
+        logger.info(f'{func_name}(**{app_kwargs})')
+        output, _ = _call(func_name, app_func, app_kwargs, table_format, strict_encode)
+        return b'{"ok": true, "result": ' + output + b'}'
+    except NotFound as e:
+        error, status = e, 404
+    except (BadRequest, werkzeug.exceptions.BadRequest) as e:
+        error, status = e, 400
+    except ServiceUnavailable as e:
+        error, status = e, 503
+    except GatewayTimeout as e:
+        error, status = e, 504
+    except Exception as e:
+        error, status = e, 500
+    # str() of werkzeug exceptions includes the status, their message is the description
+    message = getattr(error, 'description', None) or str(error)
+    logger.info(f'{type(error).__name__}: {message}')
+    return json.dumps({'ok': False, 'error': message, 'status': status}).encode('utf-8')
+
+
+def _call(
+    func_name, app_func, app_kwargs, table_format=None, strict_encode=True, output_format='json',
+    page=None, columns=None, where=None, timing=None,
+):
+    """Call an API function and return the encoded output
+
+    Results are taken from the result cache if possible, and stored in the cache otherwise.
+    Cached results are keyed by the data version of the function, so they are not used once the
+    data changes. Calls without a data version are only cached for the TTL of the function.
+
+    :param page: tuple
+        Optional (offset, limit) tuple to return only a slice of a table or list result.
+    :param columns: tuple
+        Optional names of the table columns to return.
+    :param where: str
+        Optional expression selecting the table rows to return (see the ``where`` module).
+    :param timing: Timing
+        Optional Timing where the time spent calling the function and encoding is recorded.
+    :returns: bytes, dict
+        The encoded output and a dict with information about it: the number of rows and columns
+        ('rows', 'cols') if known, and for paged calls the total length of the result ('total').
+    """
+    timing = Timing() if timing is None else timing
+    cache = current_app.extensions['ska_api_cache']
+    # results are keyed by the data version, so they are consistent with the ETag
+    cache_key = (
+        func_name, _canonical_kwargs(app_kwargs), table_format, strict_encode, output_format,
+        page, columns, where, current_app.extensions['ska_api_versions'].get(func_name, app_kwargs),
+    )
+    cached = cache.get(cache_key)
+    if cached is None:
+        def call():
+            with timing.phase('call'):
+                output, total = _get_output(
+                    func_name, app_func, app_kwargs, page, columns, where
+                )
+            info = _get_shape(output)
+            if page is not None:
+                info['total'] = total
+            with timing.phase('encode'):
+                if output_format == 'json':
+                    dumper = APIEncoder(
+                        table_format=table_format, strict_encode=strict_encode, timing=timing
+                    )
+                    output = dumper.encode(output).encode('utf-8')
+                else:
+                    output = _encode_table(output, output_format)
+            cache.set(cache_key, (output, info), size=len(output), ttl=_get_cache_ttl(func_name))
+            return output, info
+
+        # identical calls in progress in other threads share the result of the first one
+        (output, info), shared = current_app.extensions['ska_api_single_flight'].do(
+            cache_key, call
+        )
+        if shared:
+            logging.getLogger('kadi_apps').info('shared result of a call in progress')
+            timing.info['coalesced'] = True
+    else:
+        logging.getLogger('kadi_apps').info('cache hit')
+        output, info = cached
+        timing.info['cache'] = 'hit'
+    timing.info.update((key, info[key]) for key in ('rows', 'cols') if key in info)
+    return output, info
+
+
+def _get_shape(output):
+    """Return a dict with the number of rows and columns of a table (or rows of a list)"""
+    from astropy.table import Table
+
+    if isinstance(output, Table):
+        return {'rows': len(output), 'cols': len(output.colnames)}
+    if isinstance(output, (list, tuple)):
+        return {'rows': len(output)}
+    return {}
+
+
+def _get_output(func_name, app_func, app_kwargs, page=None, columns=None, where=None):
+    """Call an API function and apply the column/row selection and paging to the result
+
+    :returns: output, int
+        The output and its length before paging (None if the call is not paged).
+    """
+    if page is None and columns is None and where is None:
+        return _run(func_name, app_func, app_kwargs), None
+
+    output = _get_result(func_name, app_func, app_kwargs)
+    if columns is not None or where is not None:
+        output = _select(output, columns, where)
+    total = None
+    if page is not None:
+        paged_output = _get_page(output, *page)
+        total = len(output)
+        output = paged_output
+    return output, total
+
+
+def _get_result(func_name, app_func, app_kwargs):
+    """Call an API function and return its result, converted to a Table if possible
+
+    Table results are kept in the result cache, so they can be sliced in different ways (e.g.
+    when paging) without calling the function again.
+    """
+    from astropy.table import Table
+
+    cache = current_app.extensions['ska_api_cache']
+    cache_key = (
+        'result', func_name, _canonical_kwargs(app_kwargs),
+        current_app.extensions['ska_api_versions'].get(func_name, app_kwargs),
+    )
+    output = cache.get(cache_key)
+    if output is None:
+        def call():
+            output = _as_table(_run(func_name, app_func, app_kwargs))
+            if isinstance(output, Table):
+                size = sum(getattr(col, 'nbytes', 0) for col in output.itercols())
+                cache.set(cache_key, output, size=size, ttl=_get_cache_ttl(func_name))
+            return output
+
+        output, _ = current_app.extensions['ska_api_single_flight'].do(cache_key, call)
+    return output
+
+
+def _run(func_name, app_func, app_kwargs):
+    """Call an API function within the limits set for it in APP_LIMITS
+
+    Functions of a time range listed in tiles.TILED_FUNCTIONS are called through the tile cache.
+    """
+    tiles = current_app.extensions['ska_api_tiles']
+    plan = tiles.plan(func_name, app_kwargs) if tiles is not None else None
+    if plan is not None:
+        # the limiter might call the function in another thread, outside of the app context
+        recent_ttl = _get_cache_ttl(func_name)
+        untiled_func = app_func
+
+        def app_func(**kwargs):
+            return tiles.call(plan, untiled_func, recent_ttl)
+
+    if func_name == 'agasc.get_agasc_cone' and 'max_mag' in app_kwargs:
+        # max_mag is not an argument of get_agasc_cone, these calls can use the AGASC index
+        max_mag = app_kwargs['max_mag']
+        if isinstance(max_mag, bool) or not isinstance(max_mag, (int, float)):
+            raise BadRequest(f'max_mag must be a number, not {max_mag!r}')
+        app_func = functools.partial(
+            agasc_index.get_agasc_cone, current_app.extensions['ska_api_agasc_index'], app_func
+        )
+
+    limiter = _get_limiter(func_name)
+    if limiter is None:
+        return app_func(**app_kwargs)
+    try:
+        return limiter.run(app_func, **app_kwargs)
+    except limits.QueueFull as e:
+        raise ServiceUnavailable(f'{func_name}: {e}') from None
+    except limits.Timeout as e:
+        raise GatewayTimeout(f'{func_name}: {e}') from None
+
+
+_limiters_lock = threading.Lock()
+
+
+def _get_limiter(func_name):
+    """Return the Limiter of a function, or None if the function is not limited"""
+    limiters = current_app.extensions['ska_api_limiters']
+    limiter = limiters.get(func_name)
+    if limiter is None:
+        func_limits = next(
+            (val for glob, val in APP_LIMITS.items() if fnmatch(func_name, glob)), None
+        )
+        if func_limits is None:
+            return None
+        with _limiters_lock:
+            limiter = limiters.setdefault(func_name, limits.Limiter(**func_limits))
+    return limiter
+
+
+def _get_page(output, offset, limit):
+    from astropy.table import Table
+
+    if not isinstance(output, (Table, list, tuple)):
+        raise BadRequest('paging is only available for table and list results')
+    return output[offset:offset + limit]
+
+
+def _select(output, columns, where):
+    """Select the rows of a table matching the ``where`` expression and the given columns"""
+    from astropy.table import Table
+
+    if not isinstance(output, Table):
+        raise BadRequest('columns and where are only available for table results')
+    if where is not None:
+        try:
+            output = output[where_expr.evaluate(where, output)]
+        except where_expr.InvalidExpression as e:
+            raise BadRequest(str(e)) from None
+    if columns is not None:
+        missing = [name for name in columns if name not in output.colnames]
+        if missing:
+            raise BadRequest(f'unknown column(s): {", ".join(missing)}')
+        output = output[list(columns)]
+    return output
+
+
+def _get_selection(app_kwargs):
+    """Pop the 'columns' and 'where' arguments from the query arguments
+
+    'columns' is a list of column names, or a string of comma-separated column names. 'where' is
+    an expression selecting table rows (see the ``where`` module).
+
+    :returns: tuple
+        (columns, where), where columns is a tuple of str and where a str. Either can be None.
+    """
+    columns = app_kwargs.pop('columns', None)
+    where = app_kwargs.pop('where', None)
+    if isinstance(columns, str):
+        columns = [name.strip() for name in columns.split(',') if name.strip()]
+    if columns is not None:
+        if not isinstance(columns, (list, tuple)) or not all(
+            isinstance(name, str) for name in columns
+        ):
+            raise BadRequest('columns must be a list of column names')
+        columns = tuple(columns)
+    if where is not None:
+        where = str(where)
+        try:
+            where_expr.parse(where)
+        except where_expr.InvalidExpression as e:
+            raise BadRequest(str(e)) from None
+    return columns, where
+
+
+def _get_paging(app_kwargs, query):
+    """Pop the paging arguments from the query arguments
+
+    Pages are given either by 'offset' and 'limit', or by the opaque 'page_token' returned in the
+    X-Next-Page-Token header of the previous page. Tokens are only valid for the query they were
+    issued for. ``query`` is the tuple of arguments of ``_get_query_hash``, and it is hashed after
+    the paging arguments are popped from ``app_kwargs``.
+
+    :returns: tuple
+        (offset, limit), or None if the call is not paged.
+    """
+    import base64
+
+    page_token = app_kwargs.pop('page_token', None)
+    offset = app_kwargs.pop('offset', None)
+    limit = app_kwargs.pop('limit', None)
+    if page_token is not None:
+        try:
+            token = json.loads(base64.urlsafe_b64decode(str(page_token)))
+            offset, limit, token_query = token['offset'], token['limit'], token['query']
+        except Exception:
+            raise BadRequest('invalid page_token') from None
+        if token_query != _get_query_hash(*query):
+            raise BadRequest('page_token does not correspond to this query')
+    if offset is None and limit is None:
+        return None
+    offset = 0 if offset is None else offset
+    limit = current_app.config['SKA_API_PAGE_SIZE'] if limit is None else limit
+    if not isinstance(offset, int) or not isinstance(limit, int) or offset < 0 or limit < 1:
+        raise BadRequest('offset must be a non-negative integer and limit a positive integer')
+    return offset, limit
+
+
+def _get_page_headers(query, page, total):
+    """Return the response headers with the total length and the next page of a paged call"""
+    import base64
+    from urllib.parse import urlencode
+
+    offset, limit = page
+    headers = {
+        'X-Total-Count': str(total),
+        'Access-Control-Expose-Headers': 'X-Total-Count, X-Next-Page-Token, Link',
+    }
+    if offset + limit < total:
+        token = {
+            'offset': offset + limit,
+            'limit': limit,
+            'query': _get_query_hash(*query),
+        }
+        token = base64.urlsafe_b64encode(json.dumps(token).encode()).decode()
+        args = [
+            (key, val) for key, val in request.args.items(multi=True)
+            if key not in ('offset', 'limit', 'page_token')
+        ]
+        url = f'{request.base_url}?{urlencode(args + [("page_token", token)])}'
+        headers['X-Next-Page-Token'] = token
+        headers['Link'] = f'<{url}>; rel="next"'
+    return headers
+
+
+def _get_etag(func_name, app_kwargs, *options):
+    """Return the ETag of a call, or None if the data version of the call is not known
+
+    Calls that depend on the current time (see ``versions.TIME_DEFAULTS``) have no data version.
+
+    The ETag is a hash of the canonical call (function, arguments and output options) and of the
+    version of the data the function reads (see the ``versions`` module), so it can be checked
+    without calling the function.
+    """
+    import hashlib
+    version = current_app.extensions['ska_api_versions'].get(func_name, app_kwargs)
+    if version is None:
+        return None
+    key = repr((func_name, _canonical_kwargs(app_kwargs), options, version))
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def _get_query_hash(path, app_kwargs, table_format, columns, where):
+    """Return the hash identifying a paged query (without its paging arguments)"""
+    import hashlib
+    query = repr((path, _canonical_kwargs(app_kwargs), table_format, columns, where))
+    return hashlib.sha1(query.encode()).hexdigest()[:16]
+
+
+def build_registry():
+    """Resolve all functions allowed in APPS and add them to the registry
+
+    This imports all app modules, so the import time is not paid during a request. Modules that
+    fail to import are skipped (and will fail when a function from them is requested).
+    """
+    from importlib import import_module
+
+    logger = logging.getLogger('kadi_apps')
+    for module_parts, app_globs in APPS.items():
+        t0 = time.perf_counter()
+        module_name = '.'.join(module_parts)
+        try:
+            app_module = import_module(module_name)
+        except Exception as e:
+            logger.warning(f'ska_api: failed to import {module_name}: {e}')
+            continue
+        for app_glob in app_globs:
+            for func_parts in _expand_glob(app_module, app_glob.split('.')):
+                path = '/'.join(module_parts + tuple(func_parts))
+                try:
+                    # resolve the path as in a request, in case a deeper APPS module shadows it
+                    REGISTRY[path] = _resolve_function(path)
+                except Exception:
+                    pass
+        logger.info(f'ska_api: loaded {module_name} in {time.perf_counter() - t0:.2f} sec')
+
+
+def _expand_glob(obj, glob_parts):
+    """Yield the lists of attribute names within ``obj`` that match a dotted glob"""
+    if not glob_parts:
+        yield []
+        return
+    glob_part, glob_parts = glob_parts[0], glob_parts[1:]
+    if any(char in glob_part for char in '*?['):
+        names = [
+            name for name in dir(obj)
+            if fnmatch(name, glob_part) and (glob_part.startswith('_') or name[0] != '_')
+        ]
+    else:
+        names = [glob_part]
+    for name in names:
+        try:
+            attr = getattr(obj, name)
+        except Exception:
+            continue
+        if glob_parts or callable(attr):
+            for attr_parts in _expand_glob(attr, glob_parts):
+                yield [name] + attr_parts
+
+
 def _get_function(path):
-    from fnmatch import fnmatch
+    """Return the API function for a given URL path
+
+    The function is taken from the registry, or resolved and added to the registry if it is not
+    there yet.
+    """
+    app_func = REGISTRY.get(path)
+    if app_func is None:
+        app_func = _resolve_function(path)
+        REGISTRY[path] = app_func
+    return app_func
+
+
+def _resolve_function(path):
     from importlib import import_module
 
     # Get the module with the app function and the function within that module
@@ -105,9 +852,130 @@ def _get_args(exclude):
         except Exception:
             # Use the string itself
             app_kwargs[key] = val
+    if request.method == 'POST':
+        app_kwargs.update(_get_body_args(app_kwargs))
     return app_kwargs
 
 
+def _get_body_args(app_kwargs):
+    """Return the arguments given in the body of a POST request
+
+    The body is either a JSON object with the arguments (Content-Type application/json), or an
+    array of little-endian int64 (Content-Type application/octet-stream), which is passed as the
+    argument named by the 'body_arg' query argument ('ids' by default). Arguments in the body
+    take precedence over those in the query string.
+    """
+    import numpy as np
+
+    body_arg = app_kwargs.pop('body_arg', 'ids')
+    max_bytes = current_app.config['SKA_API_MAX_BODY_BYTES']
+    if request.content_length is None:
+        raise BadRequest('POST request must have a body with a Content-Length')
+    if request.content_length > max_bytes:
+        raise BadRequest(f'request body is larger than {max_bytes} bytes')
+    if request.mimetype == 'application/json':
+        try:
+            body = json.loads(request.get_data())
+        except ValueError as e:
+            raise BadRequest(f'invalid JSON body: {e}') from None
+        if not isinstance(body, dict):
+            raise BadRequest('JSON body must be an object with the function arguments')
+        return body
+    if request.mimetype == 'application/octet-stream':
+        data = request.get_data()
+        if len(data) % 8:
+            raise BadRequest('binary body must be an array of int64')
+        return {body_arg: np.frombuffer(data, dtype='<i8')}
+    raise BadRequest('POST body must be application/json or application/octet-stream')
+
+
+def _abbreviate_kwargs(app_kwargs, max_items=10):
+    """Return a copy of the arguments with long lists and arrays abbreviated, for logging"""
+    def abbreviate(val):
+        if isinstance(val, (list, tuple)) or hasattr(val, 'ndim'):
+            if len(val) > max_items:
+                return f'<{type(val).__name__} of {len(val)} items>'
+        return val
+    return {key: abbreviate(val) for key, val in app_kwargs.items()}
+
+
+def _get_output_format(app_kwargs):
+    """Pop the output format from the query arguments or negotiate it from the Accept header
+
+    The Accept header is only used if it explicitly lists the mimetype of a non-default format
+    with a higher quality than JSON. The default for POST requests is 'json-stream', because
+    their arguments (e.g. a long list of ids) usually make for large results.
+    """
+    default = 'json-stream' if request.method == 'POST' else 'json'
+    if 'format' in app_kwargs:
+        output_format = app_kwargs.pop('format')
+        if output_format != 'json' and output_format not in STREAM_FORMATS:
+            if not formats.is_available(output_format):
+                raise BadRequest(f'format={output_format} not allowed')
+        return output_format
+
+    mimetypes = {**STREAM_FORMATS, **formats.FORMATS}
+    accepted = [
+        (quality, output_format) for output_format, mimetype in mimetypes.items()
+        if mimetype in request.accept_mimetypes.values()
+        and (quality := request.accept_mimetypes[mimetype]) > 0
+        and (output_format in STREAM_FORMATS or formats.is_available(output_format))
+    ]
+    if accepted:
+        quality, output_format = max(accepted, key=lambda item: item[0])
+        if quality > request.accept_mimetypes['application/json']:
+            return output_format
+    return default
+
+
+def _encode_table(output, output_format):
+    from astropy.table import Table
+
+    output = _as_table(output)
+    if not isinstance(output, Table):
+        raise BadRequest(f'format={output_format} is only available for table results')
+    return formats.encode_table(output, output_format)
+
+
+def _canonical_kwargs(app_kwargs):
+    """Return a string that uniquely represents the keyword arguments of an API call
+
+    Dictionaries and sets are sorted, so equivalent calls produce the same string regardless of
+    the order of the query arguments.
+    """
+    import hashlib
+    import numpy as np
+
+    def normalize(value):
+        if isinstance(value, dict):
+            return ('dict', tuple(sorted(
+                ((normalize(key), normalize(val)) for key, val in value.items()), key=repr
+            )))
+        if isinstance(value, (set, frozenset)):
+            return ('set', tuple(sorted((normalize(val) for val in value), key=repr)))
+        if isinstance(value, (list, tuple)):
+            return (type(value).__name__, tuple(normalize(val) for val in value))
+        if isinstance(value, np.ndarray):
+            # the repr of large arrays is abbreviated, so it cannot be used as a key
+            digest = hashlib.sha1(np.ascontiguousarray(value).tobytes()).hexdigest()
+            return ('ndarray', str(value.dtype), value.shape, digest)
+        return value
+
+    return repr(normalize(app_kwargs))
+
+
+def _get_cache_ttl(func_name):
+    """Return the number of seconds to cache the results of a given function
+
+    The TTL is taken from the first glob in the SKA_API_CACHE_TTL setting that matches the
+    function name. Functions not matching any glob are not cached.
+    """
+    for func_glob, ttl in current_app.config['SKA_API_CACHE_TTL'].items():
+        if fnmatch(func_name, func_glob):
+            return ttl
+    return 0
+
+
 def _replace_object_cols_with_str(tbl):
     """Replace object cols in ``tbl`` with the str representation
 
@@ -133,17 +1001,33 @@ def _replace_object_cols_with_str(tbl):
     return tbl
 
 
+def _as_table(obj):
+    """Potentially convert something with a `table` property to an astropy Table."""
+    from astropy.table import Table
+
+    if hasattr(obj, 'table') and isinstance(obj.__class__.table, property):
+        obj_table = obj.table
+        if isinstance(obj_table, Table):
+            obj = obj_table
+    return obj
+
+
 class APIEncoder(json.JSONEncoder):
-    def __init__(self, table_format=None, strict_encode=True, **kwargs):
+    def __init__(self, table_format=None, strict_encode=True, timing=None, **kwargs):
         self.table_format = table_format or 'rows'
         super(APIEncoder, self).__init__()
         self.strict_encode = strict_encode
+        self.timing = Timing() if timing is None else timing
+
+    def _replace_object_cols_with_str(self, obj):
+        with self.timing.phase('replace_object_cols'):
+            return _replace_object_cols_with_str(obj)
 
     def encode_table(self, obj):
         if self.table_format not in ('rows', 'columns'):
             raise ValueError('table_format={} not allowed'.format(self.table_format))
 
-        obj = _replace_object_cols_with_str(obj)
+        obj = self._replace_object_cols_with_str(obj)
 
         out = {name: obj[name].tolist() for name in obj.colnames}
 
@@ -154,15 +1038,123 @@ class APIEncoder(json.JSONEncoder):
 
         return out
 
+    def iterencode_chunks(self, obj):
+        """Yield the JSON encoding of ``obj`` in chunks
+
+        The concatenated chunks are the same as ``self.encode(obj)``. Tables are encoded in
+        blocks of rows (or one column at a time if table_format is 'columns') and lists one item
+        at a time.
+        """
+        from astropy.table import Table
+
+        obj = _as_table(obj)
+        if isinstance(obj, Table):
+            if self.table_format not in ('rows', 'columns'):
+                raise ValueError('table_format={} not allowed'.format(self.table_format))
+            obj = self._replace_object_cols_with_str(obj)
+            if self.table_format == 'columns':
+                yield '{'
+                for ii, name in enumerate(obj.colnames):
+                    sep = self.item_separator if ii else ''
+                    yield f'{sep}{self.encode(name)}{self.key_separator}'
+                    yield self.encode(obj[name].tolist())
+                yield '}'
+            else:
+                yield '['
+                for ii, rows in enumerate(self._iter_table_rows(obj)):
+                    sep = self.item_separator if ii else ''
+                    yield sep + self.item_separator.join(rows)
+                yield ']'
+        elif isinstance(obj, list):
+            yield '['
+            for ii, item in enumerate(obj):
+                sep = self.item_separator if ii else ''
+                yield sep + self.encode(item)
+            yield ']'
+        else:
+            yield self.encode(obj)
+
+    def iterencode_ndjson(self, obj):
+        """Yield the newline-delimited JSON encoding of ``obj`` in chunks
+
+        Table rows and list items are written one per line. Anything else is written as a single
+        line.
+        """
+        from astropy.table import Table
+
+        obj = _as_table(obj)
+        if isinstance(obj, Table):
+            obj = self._replace_object_cols_with_str(obj)
+            for rows in self._iter_table_rows(obj):
+                yield ''.join(f'{row}\n' for row in rows)
+        elif isinstance(obj, list):
+            for item in obj:
+                yield self.encode(item) + '\n'
+        else:
+            yield self.encode(obj) + '\n'
+
+    def _iter_table_rows(self, obj):
+        """Yield lists with the JSON encoding of each row of ``obj``, STREAM_CHUNK_ROWS at a time"""
+        for i0 in range(0, len(obj), STREAM_CHUNK_ROWS):
+            yield self._encode_rows(obj[i0:i0 + STREAM_CHUNK_ROWS])
+
+    def _encode_rows(self, obj):
+        """Return a list with the JSON encoding of each row of ``obj``
+
+        The JSON text is written straight from the encoded column values using a single format
+        template for all rows, instead of creating a dict for each row. The result is the same as
+        encoding the list of dicts.
+        """
+        if not obj.colnames:
+            return [self.encode({})] * len(obj)
+        template = '{' + self.item_separator.join(
+            (self.encode(name) + self.key_separator).replace('%', '%%') + '%s'
+            for name in obj.colnames
+        ) + '}'
+        cols = [self._encode_values(obj[name]) for name in obj.colnames]
+        return [template % vals for vals in zip(*cols)]
+
+    def _encode_values(self, col):
+        """Return a list with the JSON encoding of each value in a table column"""
+        from json.encoder import encode_basestring, encode_basestring_ascii
+
+        vals = col.tolist()
+        if not vals:
+            return []
+        kind = getattr(getattr(col, 'dtype', None), 'kind', None)
+        if kind in ('b', 'i', 'u', 'f') and col.ndim == 1:
+            # booleans, numbers and nulls never contain the item separator, so the whole column
+            # is encoded in one call and then split
+            return self.encode(vals)[1:-1].split(self.item_separator)
+        if kind in ('b', 'i', 'u', 'f') and col.ndim == 2:
+            # same thing for 2-d columns, splitting at the boundaries between rows
+            row_sep = ']' + self.item_separator + '['
+            return [f'[{val}]' for val in self.encode(vals)[2:-2].split(row_sep)]
+        if kind in ('U', 'S') and col.ndim == 1:
+            encode_str = encode_basestring_ascii if self.ensure_ascii else encode_basestring
+            return [
+                'null' if val is None
+                else encode_str(val if isinstance(val, str) else val.decode('utf-8'))
+                for val in vals
+            ]
+        encode = super(APIEncoder, self).encode
+        return [encode(val) for val in vals]
+
+    def encode(self, obj):
+        from astropy.table import Table
+
+        # Tables in rows format are encoded without creating the intermediate list of dicts
+        table = _as_table(obj)
+        if isinstance(table, Table) and self.table_format == 'rows':
+            table = self._replace_object_cols_with_str(table)
+            return '[' + self.item_separator.join(self._encode_rows(table)) + ']'
+        return super(APIEncoder, self).encode(obj)
+
     def default(self, obj):
         from astropy.table import Table
         import numpy as np
 
-        # Potentially convert something with a `table` property to an astropy Table.
-        if hasattr(obj, 'table') and isinstance(obj.__class__.table, property):
-            obj_table = obj.table
-            if isinstance(obj_table, Table):
-                obj = obj_table
+        obj = _as_table(obj)
 
         if type(obj) in [np.int32, np.int64]:
             return int(obj)
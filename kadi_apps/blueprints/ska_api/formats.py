@@ -0,0 +1,140 @@
+"""
+Typed serialization formats for tables returned by the ska_api.
+
+These formats are written directly from the column buffers, so clients can rebuild the table
+without a per-cell JSON round trip:
+
+- arrow: Arrow IPC stream (requires pyarrow).
+- npz: NumPy .npz archive with one array per column. Masked columns have an extra boolean array
+  named ``<name>.mask``. Mixin columns (e.g. Time) are split into plain columns.
+- fits: binary FITS table.
+- ecsv: ECSV text, which preserves column types.
+
+Object columns are written as their str representation.
+"""
+
+import io
+import json
+
+import numpy as np
+
+
+FORMATS = {
+    'arrow': 'application/vnd.apache.arrow.stream',
+    'npz': 'application/x-npz',
+    'fits': 'application/fits',
+    'ecsv': 'text/x-ecsv',
+}
+
+
+def is_available(fmt):
+    """Check whether the dependencies to write a given format are installed"""
+    if fmt == 'arrow':
+        try:
+            import pyarrow  # noqa
+        except ImportError:
+            return False
+    return fmt in FORMATS
+
+
+def encode_table(table, fmt):
+    """Serialize an astropy Table in the given format.
+
+    :param table: Table
+    :param fmt: str
+        One of the keys in FORMATS.
+    :returns: bytes
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f'format={fmt} not allowed')
+    return WRITERS[fmt](_object_cols_to_str(table))
+
+
+def _object_cols_to_str(table):
+    """Replace all the object columns of ``table`` with their str representation
+
+    Unlike ``api._replace_object_cols_with_str``, which only converts the object columns that
+    cannot be written as JSON, this converts all of them: none of these formats can write Python
+    objects (even the JSON-serializable ones, like dicts or lists).
+
+    :returns: Table
+        Either the original table, or a copy that shares the data of the other columns.
+    """
+    object_type_colnames = [
+        name for name in table.colnames if getattr(table[name], 'dtype', None) == object
+    ]
+    if object_type_colnames:
+        table = table.copy(copy_data=False)
+        for name in object_type_colnames:
+            table[name] = [str(val) for val in table[name]]
+    return table
+
+
+def _write_ecsv(table):
+    out = io.StringIO()
+    table.write(out, format='ascii.ecsv')
+    return out.getvalue().encode('utf-8')
+
+
+def _write_fits(table):
+    out = io.BytesIO()
+    table.write(out, format='fits')
+    return out.getvalue()
+
+
+def _write_npz(table):
+    from astropy.table.serialize import represent_mixins_as_columns
+
+    table = represent_mixins_as_columns(table)
+    arrays = {}
+    for name in table.colnames:
+        col = table[name]
+        arrays[name] = np.asarray(col)
+        if getattr(col, 'mask', None) is not None:
+            arrays[f'{name}.mask'] = np.asarray(col.mask)
+    out = io.BytesIO()
+    np.savez(out, **arrays)
+    return out.getvalue()
+
+
+def _write_arrow(table):
+    import pyarrow as pa
+    from astropy.table.serialize import represent_mixins_as_columns
+
+    table = represent_mixins_as_columns(table)
+    fields = []
+    arrays = []
+    for name in table.colnames:
+        col = table[name]
+        data = np.asarray(col)
+        if data.dtype.kind == 'S':
+            data = np.char.decode(data, 'utf-8')
+        mask = np.asarray(col.mask) if getattr(col, 'mask', None) is not None else None
+        metadata = None
+        if data.ndim > 1:
+            # multidimensional columns are written as fixed-size lists of the flattened values,
+            # with the original shape in the field metadata
+            size = int(np.prod(data.shape[1:]))
+            flat_mask = mask.reshape(-1) if mask is not None else None
+            array = pa.FixedSizeListArray.from_arrays(
+                pa.array(data.reshape(-1), mask=flat_mask), size
+            )
+            metadata = {'shape': json.dumps(data.shape[1:])}
+        else:
+            array = pa.array(data, mask=mask)
+        fields.append(pa.field(name, array.type, metadata=metadata))
+        arrays.append(array)
+
+    arrow_table = pa.Table.from_arrays(arrays, schema=pa.schema(fields))
+    out = pa.BufferOutputStream()
+    with pa.ipc.new_stream(out, arrow_table.schema) as writer:
+        writer.write_table(arrow_table)
+    return out.getvalue().to_pybytes()
+
+
+WRITERS = {
+    'arrow': _write_arrow,
+    'npz': _write_npz,
+    'fits': _write_fits,
+    'ecsv': _write_ecsv,
+}
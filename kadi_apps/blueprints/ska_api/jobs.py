@@ -0,0 +1,175 @@
+"""
+Asynchronous ska_api jobs.
+
+Long calls can be submitted as jobs (``async=1``), which run in a local process pool. The status
+and the encoded result of each job are stored on disk, in a directory per job::
+
+    <jobs_dir>/<job_id>/status.json
+    <jobs_dir>/<job_id>/result
+
+so they can be fetched from any worker on the same host, and they survive worker restarts. Jobs
+expire (and are removed) a given time after they finish.
+
+Jobs that were queued or running in a process that no longer exists (e.g. after a restart) are
+reported as failed.
+"""
+
+import os
+import re
+import json
+import time
+import uuid
+import reprlib
+import shutil
+import logging
+from pathlib import Path
+
+
+JOB_ID_REGEX = re.compile('[0-9a-f]{32}')
+
+PENDING = ('queued', 'running')
+
+
+class JobStore:
+    """
+    On-disk store of job status and results.
+
+    :param root: str or Path
+        Directory where jobs are stored. It is created if it does not exist.
+    :param ttl: float
+        Seconds that finished jobs are kept.
+    """
+
+    def __init__(self, root, ttl):
+        self.root = Path(root)
+        self.ttl = ttl
+
+    def create(self, path, app_kwargs):
+        """Create a queued job and return its id"""
+        job_id = uuid.uuid4().hex
+        (self.root / job_id).mkdir(parents=True)
+        self._write_status(job_id, {
+            'job_id': job_id,
+            'status': 'queued',
+            'path': path,
+            'kwargs': reprlib.repr(app_kwargs),
+            'pid': os.getpid(),
+            'created': time.time(),
+        })
+        return job_id
+
+    def get_status(self, job_id):
+        """Return the status of a job as a dict, or None if there is no such job"""
+        if not JOB_ID_REGEX.fullmatch(job_id):
+            return None
+        try:
+            status = json.loads((self.root / job_id / 'status.json').read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        if status['status'] in PENDING and not _pid_exists(status['pid']):
+            status = self.update(
+                job_id, status='error', error='job was interrupted', error_status=500
+            )
+        if status['status'] not in PENDING and status['expires'] < time.time():
+            self.remove(job_id)
+            return None
+        return status
+
+    def update(self, job_id, **kwargs):
+        """Update the status of a job
+
+        When the status changes to 'done' or 'error', the job is set to expire after ``ttl``.
+        """
+        status = json.loads((self.root / job_id / 'status.json').read_text())
+        status.update(kwargs)
+        status['updated'] = time.time()
+        if status['status'] not in PENDING:
+            status['expires'] = status['updated'] + self.ttl
+        self._write_status(job_id, status)
+        return status
+
+    def result_path(self, job_id):
+        return self.root / job_id / 'result'
+
+    def remove(self, job_id):
+        shutil.rmtree(self.root / job_id, ignore_errors=True)
+
+    def expire(self):
+        """Remove all expired jobs"""
+        if not self.root.exists():
+            return
+        for job_dir in self.root.iterdir():
+            if job_dir.is_dir() and JOB_ID_REGEX.fullmatch(job_dir.name):
+                self.get_status(job_dir.name)
+
+    def _write_status(self, job_id, status):
+        # write and rename, so readers never see a partial file
+        filename = self.root / job_id / 'status.json'
+        tmp = filename.with_suffix(f'.{os.getpid()}.tmp')
+        tmp.write_text(json.dumps(status))
+        os.replace(tmp, filename)
+
+
+def run_job(root, ttl, job_id, path, app_kwargs, options):
+    """Run an API call and store its encoded result in the job store
+
+    This runs in a process pool, outside of any Flask application context, so it does not use the
+    result cache.
+
+    :param options: dict
+        Output options of the call: table_format, strict_encode, output_format, columns and
+        where.
+    """
+    from . import api
+
+    logger = logging.getLogger('kadi_apps')
+    store = JobStore(root, ttl)
+    store.update(job_id, status='running', pid=os.getpid(), started=time.time())
+    result_path = store.result_path(job_id)
+    tmp = result_path.with_suffix('.tmp')
+    try:
+        app_func = api._resolve_function(path)
+        output = app_func(**app_kwargs)
+        if options['columns'] is not None or options['where'] is not None:
+            output = api._select(api._as_table(output), options['columns'], options['where'])
+
+        output_format = options['output_format']
+        dumper = api.APIEncoder(
+            table_format=options['table_format'], strict_encode=options['strict_encode']
+        )
+        with open(tmp, 'wb') as fh:
+            if output_format == 'ndjson':
+                for chunk in dumper.iterencode_ndjson(output):
+                    fh.write(chunk.encode('utf-8'))
+            elif output_format in ('json', 'json-stream'):
+                for chunk in dumper.iterencode_chunks(output):
+                    fh.write(chunk.encode('utf-8'))
+            else:
+                fh.write(api._encode_table(output, output_format))
+        os.replace(tmp, result_path)
+        mimetype = {**api.STREAM_FORMATS, **api.formats.FORMATS}.get(
+            output_format, 'application/json'
+        )
+        store.update(
+            job_id, status='done', finished=time.time(), mimetype=mimetype,
+            size=result_path.stat().st_size,
+        )
+    except Exception as e:
+        logger.info(f'job {job_id} failed: {type(e).__name__}: {e}')
+        error_status = (
+            404 if isinstance(e, api.NotFound) else 400 if isinstance(e, api.BadRequest) else 500
+        )
+        tmp.unlink(missing_ok=True)
+        store.update(
+            job_id, status='error', finished=time.time(), error=str(e), error_status=error_status
+        )
+
+
+def _pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
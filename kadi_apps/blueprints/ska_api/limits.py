@@ -0,0 +1,106 @@
+"""
+Concurrency limits and timeouts for ska_api functions.
+"""
+
+import time
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Timeout(Exception):
+    pass
+
+
+class Limiter:
+    """
+    Limit the concurrent executions of a function.
+
+    Calls beyond ``max_concurrent`` wait for a free slot. If there are already ``max_queue`` calls
+    waiting, the call is rejected with QueueFull. If the call does not finish within ``timeout``
+    seconds (waiting included), Timeout is raised. The function keeps running in the background
+    in that case (threads cannot be killed), and it holds its slot until it finishes, so runaway
+    calls still count towards the limit.
+
+    :param max_concurrent: int
+        Maximum number of concurrent executions (None for no limit).
+    :param max_queue: int
+        Maximum number of calls waiting for a slot (None for no limit).
+    :param timeout: float
+        Wall-clock timeout in seconds (None for no timeout).
+    """
+
+    def __init__(self, max_concurrent=None, max_queue=None, timeout=None):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.running = 0
+        self.waiting = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self._cond = threading.Condition()
+
+    def run(self, func, **kwargs):
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        self._acquire(deadline)
+        if deadline is None:
+            try:
+                return func(**kwargs)
+            finally:
+                self._release()
+
+        future = Future()
+
+        def target():
+            try:
+                future.set_result(func(**kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                self._release()
+
+        threading.Thread(target=target, daemon=True, name='ska_api_limited').start()
+        try:
+            return future.result(timeout=max(deadline - time.monotonic(), 0))
+        except FutureTimeoutError:
+            with self._cond:
+                self.timeouts += 1
+            raise Timeout(f'call did not finish in {self.timeout} sec') from None
+
+    def stats(self):
+        with self._cond:
+            return {
+                'max_concurrent': self.max_concurrent,
+                'max_queue': self.max_queue,
+                'timeout': self.timeout,
+                'running': self.running,
+                'waiting': self.waiting,
+                'rejected': self.rejected,
+                'timeouts': self.timeouts,
+            }
+
+    def _acquire(self, deadline):
+        with self._cond:
+            if self.max_concurrent is not None and self.running >= self.max_concurrent:
+                if self.max_queue is not None and self.waiting >= self.max_queue:
+                    self.rejected += 1
+                    raise QueueFull(f'too many calls in progress ({self.waiting} waiting)')
+                self.waiting += 1
+                try:
+                    while self.running >= self.max_concurrent:
+                        timeout = None if deadline is None else deadline - time.monotonic()
+                        if timeout is not None and timeout <= 0:
+                            self.timeouts += 1
+                            raise Timeout(f'call did not start in {self.timeout} sec')
+                        self._cond.wait(timeout)
+                finally:
+                    self.waiting -= 1
+            self.running += 1
+
+    def _release(self):
+        with self._cond:
+            self.running -= 1
+            self._cond.notify()
@@ -0,0 +1,210 @@
+"""
+Time-tiled cache for ska_api functions of a time range.
+
+Calls like ``kadi.commands.get_cmds(start, stop)`` are split into fixed time tiles (e.g. one
+day). Each tile is computed by calling the function with the tile start and stop, and it is
+cached, so a request that overlaps previous requests only computes the missing tiles. The tiles
+are then stitched together and trimmed to the requested range.
+
+How a tile is cached depends on how close it is to the current time:
+
+- Tiles that contain the current time are never cached.
+- Tiles that end less than ``recent`` seconds ago, or in the future, can change when the data is
+  updated (e.g. when a load is approved). They are cached with the regular TTL of the function
+  and keyed by the version of the data (the modification times of the kadi commands archive or
+  events database), so they are recomputed as soon as the data changes.
+- Older tiles are cached for ``ttl`` seconds.
+"""
+
+import math
+from fnmatch import fnmatch
+
+import numpy as np
+
+from . import versions
+
+
+# Functions that can be tiled, keyed by function name glob:
+# - stitch: how tiles are put together (see STITCHERS).
+# - data: the data the function depends on (see DATA_VERSIONS).
+# - exclude: arguments for which the call is not tiled.
+#
+# kadi.commands.states.get_states is not tiled: the states of a tile depend on the continuity at
+# the tile start (e.g. the trans_keys of the first state), so stitched tiles are not the same as
+# a direct call.
+TILED_FUNCTIONS = {
+    'kadi.commands.get_cmds': {
+        'stitch': 'cmds', 'data': 'commands', 'exclude': ['inclusive_stop'],
+    },
+    'kadi.events.*.filter': {
+        'stitch': 'events', 'data': 'events', 'exclude': ['obsid', 'subset'],
+    },
+}
+
+class TileCache:
+    """
+    Cache the results of time-range functions in fixed time tiles.
+
+    :param cache: Cache
+        Cache where the tiles are stored.
+    :param tile_size: float
+        Tile size in seconds. Tiles are aligned to multiples of this in CXC seconds.
+    :param max_tiles: int
+        Calls spanning more tiles than this are not tiled.
+    :param ttl: float
+        Seconds that tiles older than ``recent`` are cached.
+    :param recent: float
+        Tiles that end less than this many seconds ago are keyed by the data version.
+    """
+
+    def __init__(self, cache, tile_size, max_tiles, ttl, recent):
+        self.cache = cache
+        self.tile_size = tile_size
+        self.max_tiles = max_tiles
+        self.ttl = ttl
+        self.recent = recent
+
+    def plan(self, func_name, app_kwargs):
+        """Return the tiling plan of a call as a dict, or None if the call is not tiled
+
+        Calls are tiled if the function is in TILED_FUNCTIONS, both start and stop are given, and
+        the time range spans between one and ``max_tiles`` tiles.
+        """
+        from cxotime import CxoTime
+
+        spec = next(
+            (spec for glob, spec in TILED_FUNCTIONS.items() if fnmatch(func_name, glob)), None
+        )
+        if (
+            spec is None
+            or 'start' not in app_kwargs
+            or 'stop' not in app_kwargs
+            or any(key in app_kwargs for key in spec['exclude'])
+        ):
+            return None
+        try:
+            start = CxoTime(app_kwargs['start']).secs
+            stop = CxoTime(app_kwargs['stop']).secs
+        except Exception:
+            # let the function itself complain about the arguments
+            return None
+        i0 = math.floor(start / self.tile_size)
+        i1 = math.ceil(stop / self.tile_size)
+        if stop - start < self.tile_size or i1 - i0 > self.max_tiles:
+            return None
+        kwargs = {key: val for key, val in app_kwargs.items() if key not in ('start', 'stop')}
+        return {
+            'func_name': func_name,
+            'spec': spec,
+            'start': start,
+            'stop': stop,
+            'tiles': range(i0, i1),
+            'kwargs': kwargs,
+        }
+
+    def call(self, plan, app_func, recent_ttl):
+        """Call a function tile by tile and return the stitched result
+
+        :param plan: dict
+            Tiling plan returned by ``plan()``.
+        :param recent_ttl: float
+            TTL of the tiles that depend on recent data (the TTL of the function).
+        """
+        from cxotime import CxoTime
+        from .api import _canonical_kwargs
+
+        now = CxoTime.now().secs
+        kwargs_key = _canonical_kwargs(plan['kwargs'])
+        version = None
+        tables = []
+        for ii in plan['tiles']:
+            t0, t1 = ii * self.tile_size, (ii + 1) * self.tile_size
+            if t0 <= now < t1:
+                tables.append(self._compute(plan, app_func, t0, t1))
+                continue
+            if t1 > now - self.recent:
+                if version is None:
+                    version = DATA_VERSIONS[plan['spec']['data']]()
+                key = ('tile', plan['func_name'], kwargs_key, t0, t1, version)
+                ttl = recent_ttl
+            else:
+                key = ('tile', plan['func_name'], kwargs_key, t0, t1)
+                ttl = self.ttl
+            table = self.cache.get(key)
+            if table is None:
+                table = self._compute(plan, app_func, t0, t1)
+                size = sum(getattr(col, 'nbytes', 0) for col in table.itercols())
+                self.cache.set(key, table, size=size, ttl=ttl)
+            tables.append(table)
+        stitch = STITCHERS[plan['spec']['stitch']]
+        return stitch(tables, plan['start'], plan['stop'], app_func)
+
+    def _compute(self, plan, app_func, t0, t1):
+        from cxotime import CxoTime
+        from .api import _as_table
+
+        return _as_table(
+            app_func(start=CxoTime(t0).date, stop=CxoTime(t1).date, **plan['kwargs'])
+        )
+
+
+def stitch_cmds(tables, start, stop, app_func=None):
+    """Stack command tiles and keep the commands with start <= date < stop"""
+    table = _vstack(tables)
+    dates = table['date']
+    i0, i1 = np.searchsorted(dates, [_date(start, dates), _date(stop, dates)])
+    return table[i0:i1]
+
+
+def stitch_events(tables, start, stop, app_func=None):
+    """Stack event tiles, remove events repeated in several tiles, and keep those overlapping
+    start/stop (as in ``EventQuery.filter``)."""
+    # empty tiles might not have any columns
+    tables = [table for table in tables if len(table)] or tables[:1]
+    table = _vstack(tables)
+    if len(table) == 0:
+        return table
+    pk_name = _get_pk_name(app_func)
+    _, index = np.unique(np.asarray(table[pk_name]), return_index=True)
+    table = table[np.sort(index)]
+    keep = (
+        (table['stop'] > _date(start, table['stop']))
+        & (table['start'] < _date(stop, table['start']))
+    )
+    return table[keep]
+
+
+STITCHERS = {
+    'cmds': stitch_cmds,
+    'events': stitch_events,
+}
+
+
+DATA_VERSIONS = {
+    'commands': versions.get_commands_version,
+    'events': versions.get_events_version,
+}
+
+
+def _vstack(tables):
+    from astropy.table import vstack
+    if len(tables) == 1:
+        return tables[0].copy()
+    return vstack(tables, join_type='exact', metadata_conflicts='silent')
+
+
+def _date(secs, like):
+    """Return the date string of a time in CXC seconds, as bytes if ``like`` is a bytes column"""
+    from cxotime import CxoTime
+    date = CxoTime(secs).date
+    if getattr(getattr(like, 'dtype', None), 'kind', None) == 'S':
+        date = date.encode('ascii')
+    return date
+
+
+def _get_pk_name(app_func):
+    """Return the primary key of the event model of an EventQuery.filter function"""
+    try:
+        return app_func.__self__.cls._meta.pk.name
+    except AttributeError:
+        return 'start'
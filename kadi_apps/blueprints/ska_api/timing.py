@@ -0,0 +1,60 @@
+"""
+Timing of the phases of a ska_api request.
+"""
+
+import time
+from contextlib import contextmanager
+
+
+class Timing:
+    """
+    Accumulate the time spent in each phase of a request.
+
+    Phases can be nested, in which case the time spent in the inner phase is not counted in the
+    outer one (e.g. 'replace_object_cols' within 'encode'). Other information about the request
+    (row and column counts, encoded size...) is kept in the ``info`` dict.
+
+    Example::
+
+        timing = Timing()
+        with timing.phase('call'):
+            result = func()
+        timing.header()  # 'call;dur=12.3, total;dur=12.4'
+    """
+
+    def __init__(self):
+        self.durations = {}
+        self.info = {}
+        self._nested = []
+        self._t0 = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name):
+        t0 = time.perf_counter()
+        self._nested.append(0.)
+        try:
+            yield
+        finally:
+            dt = time.perf_counter() - t0
+            nested = self._nested.pop()
+            self.durations[name] = self.durations.get(name, 0.) + dt - nested
+            if self._nested:
+                self._nested[-1] += dt
+
+    def total(self):
+        return time.perf_counter() - self._t0
+
+    def header(self):
+        """Return the value of the Server-Timing header (durations in milliseconds)"""
+        metrics = [f'{name};dur={dt * 1000:.1f}' for name, dt in self.durations.items()]
+        metrics.append(f'total;dur={self.total() * 1000:.1f}')
+        if self.info:
+            desc = ' '.join(f'{key}={val}' for key, val in self.info.items())
+            metrics.append(f'output;desc="{desc}"')
+        return ', '.join(metrics)
+
+    def __str__(self):
+        items = [f'{name}={dt * 1000:.1f}ms' for name, dt in self.durations.items()]
+        items.append(f'total={self.total() * 1000:.1f}ms')
+        items.extend(f'{key}={val}' for key, val in self.info.items())
+        return ' '.join(items)
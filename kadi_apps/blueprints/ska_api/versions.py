@@ -0,0 +1,177 @@
+"""
+Versions of the data behind the ska_api functions.
+
+The result of most ska_api functions only changes when the data they read changes (a new AGASC
+supplement, a new dark calibration, an update of the kadi commands archive...). The version of
+that data is a fingerprint of the package version and of the modification times of the data
+files, which is cheap to compute. It is used to build the ETag of the responses, and to key the
+recent tiles of the tile cache.
+
+Functions are matched to their data by function name glob in DATA_SOURCES. Functions that do not
+match any glob have no data version (and their responses have no ETag). Calls that leave out an
+argument listed in TIME_DEFAULTS also have no data version, their result depends on the time of
+the call.
+"""
+
+import os
+import time
+import threading
+from fnmatch import fnmatch
+from pathlib import Path
+
+
+class DataVersions:
+    """
+    Data versions of the ska_api functions, recomputed at most every ``ttl`` seconds.
+
+    :param ttl: float
+        Seconds that a data version is reused before checking the data files again.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, func_name, app_kwargs=None):
+        """Return the data version of a function, or None if it is not known
+
+        :param app_kwargs: dict
+            Optional arguments of the call. If an argument that defaults to the current time is
+            missing, the call has no data version.
+        :returns: str
+        """
+        if app_kwargs is not None and depends_on_time(func_name, app_kwargs):
+            return None
+        source = next(
+            (source for glob, source in DATA_SOURCES.items() if fnmatch(func_name, glob)), None
+        )
+        if source is None:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            version, expires = self._versions.get(source, (None, 0))
+        if expires <= now:
+            try:
+                version = repr(SOURCES[source]())
+            except Exception:
+                # e.g. missing data files. No version means no ETag, which is always safe.
+                version = None
+            with self._lock:
+                self._versions[source] = (version, now + self.ttl)
+        return version
+
+
+def depends_on_time(func_name, app_kwargs):
+    """Return True if a call leaves out an argument that defaults to the current time"""
+    return any(
+        app_kwargs.get(name) is None
+        for glob, names in TIME_DEFAULTS.items() if fnmatch(func_name, glob)
+        for name in names
+    )
+
+
+def get_agasc_version():
+    """Return the agasc version and the modification times of the AGASC files"""
+    import agasc
+    agasc_dir = Path(agasc.get_agasc_filename()).parent
+    return agasc.__version__, _get_mtimes(agasc_dir, '*.h5')
+
+
+def get_dark_cal_version():
+    """Return the mica version and the modification times of the dark cal archive"""
+    import mica
+    from mica.common import MICA_ARCHIVE
+    return mica.__version__, _get_mtimes(Path(MICA_ARCHIVE) / 'aca_dark', '*')
+
+
+def get_starcheck_version():
+    """Return the mica version and the modification times of the starcheck database
+
+    Some starcheck functions also look up kadi commands and events (e.g. to find the catalog
+    at a date), so their versions are included.
+    """
+    import mica
+    from mica.common import MICA_ARCHIVE
+    return (
+        mica.__version__,
+        _get_mtimes(Path(MICA_ARCHIVE) / 'starcheck', '*'),
+        get_commands_version(),
+        get_events_version(),
+    )
+
+
+def get_commands_version():
+    """Return the modification times of the kadi commands archive files
+
+    This includes the command events and the approved loads, which are used for the commands
+    after the end of the archive.
+    """
+    import kadi.paths
+    data_dir = kadi.paths.DATA_DIR()
+    return tuple(
+        mtime for pattern in ('cmds*', 'cmd_events*', 'loads')
+        for mtime in _get_mtimes(data_dir, pattern)
+    )
+
+
+def get_events_version():
+    """Return the modification time of the kadi events database
+
+    If kadi events are read from an in-memory snapshot of the database (see the kadi blueprint),
+    this is the modification time of the database when the snapshot was taken.
+    """
+    import kadi.paths
+    from flask import current_app, has_app_context
+    path = kadi.paths.EVENTS_DB_PATH()
+    events_snapshot = current_app.extensions.get('kadi_snapshot') if has_app_context() else None
+    version = None if events_snapshot is None else events_snapshot.get_version()
+    if version is not None:
+        return ((os.path.basename(path), version),)
+    return _get_mtimes(os.path.dirname(path), os.path.basename(path))
+
+
+def get_kadi_commands_version():
+    import kadi
+    return kadi.__version__, get_commands_version()
+
+
+def get_kadi_events_version():
+    import kadi
+    return kadi.__version__, get_events_version()
+
+
+# Functions that compute the version of each data source
+SOURCES = {
+    'agasc': get_agasc_version,
+    'dark_cal': get_dark_cal_version,
+    'starcheck': get_starcheck_version,
+    'kadi_commands': get_kadi_commands_version,
+    'kadi_events': get_kadi_events_version,
+}
+
+# Data source of the functions, keyed by function name glob (the first match is used)
+DATA_SOURCES = {
+    'agasc.*': 'agasc',
+    'mica.archive.aca_dark.dark_cal.*': 'dark_cal',
+    'mica.starcheck.*': 'starcheck',
+    'kadi.commands.*': 'kadi_commands',
+    'kadi.events.*': 'kadi_events',
+}
+
+
+# Arguments that default to the current time, keyed by function name glob (all matches apply)
+TIME_DEFAULTS = {
+    'agasc.get_agasc_cone': ['date'],
+    'agasc.get_star': ['date'],
+    'mica.starcheck.get_starcheck_catalog_at_date': ['date'],
+    'kadi.commands.states.get_states': ['stop'],
+    'kadi.commands.get_observations': ['stop'],
+    'kadi.commands.get_starcats': ['stop'],
+}
+
+
+def _get_mtimes(directory, pattern):
+    return tuple(sorted(
+        (path.name, path.stat().st_mtime_ns) for path in Path(directory).glob(pattern)
+    ))
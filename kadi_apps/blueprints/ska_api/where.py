@@ -0,0 +1,191 @@
+"""
+Row predicates for ska_api table results.
+
+A predicate is a Python-like boolean expression on the table columns, e.g.::
+
+    pitch > 90 and obsid != 0
+    (MAG_ACA < 10.5) & (CLASS in (0, 1))
+
+The expression is parsed with the ``ast`` module and only a small set of operations is allowed:
+comparisons (including chained comparisons and ``in``/``not in`` with a tuple or list of
+literals), boolean operators (``and``, ``or``, ``not``, ``&``, ``|``, ``~``), the arithmetic
+operators ``+``, ``-``, ``*`` and ``/`` (on numbers and numeric columns only), literals, and
+column names. The expression is never
+passed to ``eval``, it is evaluated on the table columns using numpy.
+"""
+
+import ast
+import operator
+from functools import reduce, lru_cache
+
+import numpy as np
+
+
+MAX_EXPRESSION_LENGTH = 1000
+
+
+class InvalidExpression(ValueError):
+    pass
+
+
+COMPARISONS = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+}
+
+BINARY_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.BitAnd: np.logical_and,
+    ast.BitOr: np.logical_or,
+}
+
+# operators that only apply to numbers (e.g. a string or list times a large number would take an
+# arbitrary amount of memory)
+ARITHMETIC_OPERATORS = {ast.Add, ast.Sub, ast.Mult, ast.Div}
+
+UNARY_OPERATORS = {
+    ast.Not: np.logical_not,
+    ast.Invert: np.logical_not,
+    ast.USub: operator.neg,
+    ast.UAdd: operator.pos,
+}
+
+
+def evaluate(expression, table):
+    """Evaluate a predicate on a table
+
+    :param expression: str
+    :param table: Table
+    :returns: numpy.ndarray
+        Boolean mask with one entry per row. Masked values evaluate to False.
+    """
+    func = parse(expression)
+    missing = [name for name in func.colnames if name not in table.colnames]
+    if missing:
+        raise InvalidExpression(f'unknown column(s) in where expression: {", ".join(missing)}')
+    mask = func(table)
+    mask = np.ma.filled(mask, False) if np.ma.isMaskedArray(mask) else np.asarray(mask)
+    if mask.dtype != bool:
+        raise InvalidExpression('where expression does not evaluate to a boolean')
+    return np.broadcast_to(mask, (len(table),))
+
+
+@lru_cache(maxsize=256)
+def parse(expression):
+    """Parse a predicate into a function of a table
+
+    The returned function has a ``colnames`` attribute with the names of the columns used in the
+    expression.
+    """
+    if len(expression) > MAX_EXPRESSION_LENGTH:
+        raise InvalidExpression(
+            f'where expression is too long (max is {MAX_EXPRESSION_LENGTH} characters)'
+        )
+    try:
+        tree = ast.parse(expression.strip(), mode='eval')
+    except SyntaxError as e:
+        raise InvalidExpression(f'invalid where expression: {e.msg}') from None
+    colnames = set()
+    func = _compile(tree.body, colnames)
+    func.colnames = sorted(colnames)
+    return func
+
+
+def _compile(node, colnames):
+    if isinstance(node, ast.Name):
+        colnames.add(node.id)
+        return lambda table: table[node.id]
+
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float, str, bool)):
+        return lambda table: node.value
+
+    if isinstance(node, (ast.Tuple, ast.List)):
+        values = [_compile(elt, colnames) for elt in node.elts]
+        if not all(isinstance(elt, ast.Constant) for elt in node.elts):
+            raise InvalidExpression('only literals are allowed in tuples and lists')
+        return lambda table: [value(table) for value in values]
+
+    if isinstance(node, ast.BoolOp):
+        op = np.logical_and if isinstance(node.op, ast.And) else np.logical_or
+        values = [_compile(value, colnames) for value in node.values]
+        return lambda table: reduce(op, (value(table) for value in values))
+
+    if isinstance(node, ast.UnaryOp) and type(node.op) in UNARY_OPERATORS:
+        op = UNARY_OPERATORS[type(node.op)]
+        operand = _compile(node.operand, colnames)
+        return lambda table: op(operand(table))
+
+    if isinstance(node, ast.BinOp) and type(node.op) in BINARY_OPERATORS:
+        op = BINARY_OPERATORS[type(node.op)]
+        left = _compile(node.left, colnames)
+        right = _compile(node.right, colnames)
+        if type(node.op) in ARITHMETIC_OPERATORS:
+            for operand in (node.left, node.right):
+                if isinstance(operand, (ast.Constant, ast.Tuple, ast.List)):
+                    _check_numeric(getattr(operand, 'value', None))
+            return lambda table: op(_check_numeric(left(table)), _check_numeric(right(table)))
+        return lambda table: op(left(table), right(table))
+
+    if isinstance(node, ast.Compare):
+        operands = [_compile(operand, colnames) for operand in [node.left] + node.comparators]
+        ops = [_compile_comparison(op) for op in node.ops]
+
+        def compare(table):
+            values = [operand(table) for operand in operands]
+            return reduce(np.logical_and, (
+                op(left, right) for op, left, right in zip(ops, values[:-1], values[1:])
+            ))
+        return compare
+
+    raise InvalidExpression(f'{type(node).__name__} is not allowed in where expressions')
+
+
+def _check_numeric(value):
+    """Check that an operand of an arithmetic operator is a number or a numeric column"""
+    dtype = getattr(value, 'dtype', None)
+    if dtype is not None:
+        numeric = dtype.kind in 'iuf'
+    else:
+        numeric = isinstance(value, (int, float)) and not isinstance(value, bool)
+    if not numeric:
+        raise InvalidExpression('arithmetic operators only apply to numbers and numeric columns')
+    return value
+
+
+def _compile_comparison(op):
+    if isinstance(op, (ast.In, ast.NotIn)):
+        def isin(left, right):
+            if not isinstance(right, list):
+                raise InvalidExpression('"in" requires a tuple or list of values')
+            left, right = _match_string_types(left, np.array(right))
+            result = np.isin(left, right)
+            return result if isinstance(op, ast.In) else ~result
+        return isin
+
+    if type(op) not in COMPARISONS:
+        raise InvalidExpression(f'{type(op).__name__} is not allowed in where expressions')
+    compare = COMPARISONS[type(op)]
+    return lambda left, right: compare(*_match_string_types(left, right))
+
+
+def _match_string_types(left, right):
+    """Encode str values compared with bytes columns (and vice versa)"""
+    def kind(value):
+        if isinstance(value, str):
+            return 'U'
+        if isinstance(value, bytes):
+            return 'S'
+        return getattr(getattr(value, 'dtype', None), 'kind', None)
+
+    if kind(left) == 'S' and kind(right) == 'U':
+        right = np.char.encode(right, 'utf-8') if isinstance(right, np.ndarray) else right.encode()
+    elif kind(left) == 'U' and kind(right) == 'S':
+        left = np.char.encode(left, 'utf-8') if isinstance(left, np.ndarray) else left.encode()
+    return left, right
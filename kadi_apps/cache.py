@@ -0,0 +1,124 @@
+"""
+In-process caches shared by the kadi_apps blueprints.
+"""
+
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class Cache:
+    """
+    Size-bounded LRU cache with per-entry expiration.
+
+    Each entry is stored with its size (in bytes) and an expiration time. When the total size of
+    the entries exceeds ``max_bytes``, the least recently used entries are evicted.
+
+    :param max_bytes: int
+        Maximum total size of the cached entries.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] < time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, size, ttl):
+        """
+        Add an entry to the cache.
+
+        Entries with non-positive ``ttl`` or larger than ``max_bytes`` are not stored.
+        """
+        if ttl <= 0 or size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, time.monotonic() + ttl)
+            self.n_bytes += size
+            while self.n_bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.n_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.n_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.n_bytes -= size
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls with the same key.
+
+    While a call is in progress, other calls with the same key wait for it and get its result (or
+    its exception) instead of running the function again. Calls made after it finishes run the
+    function again (use a Cache to keep results).
+    """
+
+    def __init__(self):
+        self.coalesced = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        """
+        Call ``func()``, unless a call with the same key is in progress.
+
+        :returns: tuple
+            The result of the call, and a bool that is True if the result came from another call.
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            return future.result(), True
+
+        try:
+            result = func()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            with self._lock:
+                del self._calls[key]
@@ -0,0 +1,138 @@
+"""
+Response compression negotiated with the Accept-Encoding request header.
+
+gzip is always available. brotli ('br') and zstandard ('zstd') are used if the brotli and
+zstandard packages are installed. Streamed responses are compressed chunk by chunk, flushing
+the compressor after each chunk so clients get data as soon as it is produced.
+"""
+
+import zlib
+
+from flask import request
+
+
+def _gzip_compressor(level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # 31: gzip header and trailer
+
+    def compress(chunk):
+        return compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    return compress, compressor.flush
+
+
+def _brotli_compressor(level):
+    import brotli
+    compressor = brotli.Compressor(quality=level)
+
+    def compress(chunk):
+        return compressor.process(chunk) + compressor.flush()
+
+    return compress, compressor.finish
+
+
+def _zstd_compressor(level):
+    import zstandard
+    compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(chunk):
+        return (
+            compressor.compress(chunk) + compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        )
+
+    return compress, compressor.flush
+
+
+COMPRESSORS = {
+    'br': _brotli_compressor,
+    'zstd': _zstd_compressor,
+    'gzip': _gzip_compressor,
+}
+
+
+def _is_available(encoding):
+    try:
+        if encoding == 'br':
+            import brotli  # noqa
+        elif encoding == 'zstd':
+            import zstandard  # noqa
+    except ImportError:
+        return False
+    return encoding in COMPRESSORS
+
+
+def init_app(app):
+    """Compress the responses of all blueprints of a Flask app
+
+    The behavior is set by the following settings:
+
+    - COMPRESSION_ENCODINGS: list of encodings in order of preference.
+    - COMPRESSION_LEVELS: dict with the compression level of each encoding.
+    - COMPRESSION_MIN_SIZE: responses smaller than this (in bytes) are not compressed. Streamed
+      responses are always compressed.
+    - COMPRESSION_MIMETYPES: list of mimetypes that are compressed.
+    """
+    encodings = [
+        encoding for encoding in app.config['COMPRESSION_ENCODINGS'] if _is_available(encoding)
+    ]
+    levels = app.config['COMPRESSION_LEVELS']
+    min_size = app.config['COMPRESSION_MIN_SIZE']
+    mimetypes = set(app.config['COMPRESSION_MIMETYPES'])
+
+    @app.after_request
+    def compress_response(response):
+        if (
+            response.status_code != 200
+            or response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+            or 'Content-Range' in response.headers
+            or response.mimetype not in mimetypes
+            or 'no-transform' in response.headers.get('Cache-Control', '')
+        ):
+            return response
+
+        # the response depends on Accept-Encoding even if it ends up not being compressed
+        response.vary.add('Accept-Encoding')
+
+        if not response.is_streamed and len(response.get_data()) < min_size:
+            return response
+
+        encoding = _negotiate(encodings)
+        if encoding is None:
+            return response
+
+        compress, finish = COMPRESSORS[encoding](levels[encoding])
+        if response.is_streamed:
+            chunks = response.response
+
+            def compressed_chunks():
+                try:
+                    for chunk in chunks:
+                        if isinstance(chunk, str):
+                            chunk = chunk.encode('utf-8')
+                        yield compress(chunk)
+                    yield finish()
+                finally:
+                    if hasattr(chunks, 'close'):
+                        chunks.close()
+
+            response.response = compressed_chunks()
+            response.headers.pop('Content-Length', None)
+        else:
+            response.set_data(compress(response.get_data()) + finish())
+
+        response.headers['Content-Encoding'] = encoding
+        # the compressed body is not byte-identical to the original, so ETags become weak
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
+
+
+def _negotiate(encodings):
+    """Return the encoding with highest quality in Accept-Encoding (preference order on ties)"""
+    best, best_quality = None, 0
+    for encoding in encodings:
+        quality = request.accept_encodings[encoding]
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
@@ -1,4 +1,5 @@
 import os
+import tempfile
 import datetime
 from pathlib import Path
 
@@ -19,4 +20,84 @@ SEND_FILE_MAX_AGE_DEFAULT = 5
 
 TOKEN_VALIDITY = datetime.timedelta(seconds=10)
 REFRESH_TOKEN_VALIDITY = datetime.timedelta(minutes=2)
-REFRESH_TOKEN_MARGIN = datetime.timedelta(seconds=20)
\ No newline at end of file
+REFRESH_TOKEN_MARGIN = datetime.timedelta(seconds=20)
+
+# ska_api results are cached in memory (per worker) up to this total size in bytes
+SKA_API_CACHE_MAX_BYTES = 64 * 1024**2
+# seconds that ska_api results are cached, keyed by function glob (the first match is used)
+SKA_API_CACHE_TTL = {
+    'kadi.commands.*': 60,
+    'kadi.events.*': 60,
+    '*': 60,
+}
+
+# ska_api batch requests: maximum number of calls per request, and the number of threads that
+# run them (shared by all batch requests in a worker)
+SKA_API_BATCH_MAX_CALLS = 100
+SKA_API_BATCH_MAX_WORKERS = 8
+
+# import all ska_api app modules at startup, instead of on the first request that uses them
+SKA_API_WARM_UP = False
+
+# default number of rows per page when paging ska_api results with 'offset' but no 'limit'
+SKA_API_PAGE_SIZE = 1000
+
+# response compression, negotiated with the Accept-Encoding header. Encodings are listed in order
+# of preference ('br' and 'zstd' require the brotli and zstandard packages).
+COMPRESSION_ENCODINGS = ['br', 'zstd', 'gzip']
+COMPRESSION_LEVELS = {'br': 4, 'zstd': 3, 'gzip': 6}
+COMPRESSION_MIN_SIZE = 1024
+COMPRESSION_MIMETYPES = [
+    'text/html', 'text/css', 'text/plain', 'text/csv', 'text/x-ecsv', 'application/javascript',
+    'application/json', 'application/x-ndjson',
+]
+
+# ska_api async jobs: directory where job results are stored (on local disk), seconds that
+# finished jobs are kept, and number of processes that run jobs (per worker)
+SKA_API_JOBS_DIR = os.path.join(tempfile.gettempdir(), 'kadi_apps_jobs')
+SKA_API_JOBS_TTL = 3600
+SKA_API_JOBS_MAX_WORKERS = 2
+
+# time-tiled cache of ska_api time range functions (kadi commands and events): tile size
+# in seconds (None to disable), maximum number of tiles in a call, seconds that tiles are cached,
+# and how recent (in seconds) tiles need to be to be invalidated when the kadi data changes.
+SKA_API_TILE_SIZE = 86400
+SKA_API_TILE_MAX_TILES = 60
+SKA_API_TILE_TTL = 24 * 3600
+SKA_API_TILE_RECENT = 14 * 86400
+
+# in-memory index of the AGASC stars brighter than SKA_API_AGASC_INDEX_MAX_MAG, used for
+# agasc/get_agasc_cone calls with max_mag and radius below SKA_API_AGASC_INDEX_MAX_RADIUS (deg).
+# It is loaded at startup in each worker (a few hundred MB).
+SKA_API_AGASC_INDEX = False
+SKA_API_AGASC_INDEX_MAX_MAG = 10.5
+SKA_API_AGASC_INDEX_MAX_RADIUS = 2.0
+
+# maximum size (bytes) of the body of a POST request to ska_api
+SKA_API_MAX_BODY_BYTES = 16 * 1024**2
+
+# seconds that the data version of the ska_api functions (used in ETags) is reused before
+# checking the data files again
+SKA_API_DATA_VERSION_TTL = 10
+
+# kadi events browser query results (e.g. event counts) are cached in memory (per worker) up to
+# this total size in bytes, and for this many seconds. They are also invalidated when the events
+# database changes.
+KADI_CACHE_MAX_BYTES = 16 * 1024**2
+KADI_CACHE_TTL = 24 * 3600
+
+# seconds that the rendered kadi events browser pages are cached (in the kadi cache above). They
+# are also invalidated when the events database changes.
+KADI_PAGE_CACHE_TTL = 60
+
+# kadi events exports (list.json and list.csv) are read from the database and sent in blocks of
+# this many rows
+KADI_EXPORT_CHUNK_ROWS = 2000
+
+# sidecar SQLite database with a full-text index of the text fields of kadi events (used for
+# free-text filters in the events browser). None disables the index.
+KADI_FTS_DB = os.path.join(tempfile.gettempdir(), 'kadi_apps_fts.db3')
+
+# load the kadi events database into an in-memory SQLite database in each worker, and read events
+# from there. The copy is replaced when the database changes.
+KADI_EVENTS_SNAPSHOT = False
@@ -0,0 +1,546 @@
+import re
+import html
+
+import pytest
+from cxotime import CxoTime
+
+import kadi.events
+from kadi.events import models
+from kadi_apps.blueprints.kadi import kadi as kadi_views
+
+
+@pytest.fixture(scope='module')
+def kadi_app(tmp_path_factory):
+    from flask import Flask
+    from jinja2 import DictLoader
+
+    app = Flask(__name__)
+    # the site layout links to the other blueprints, event pages only need its content block
+    app.jinja_loader = DictLoader({'base.html': '{% block content %}{% endblock %}'})
+    app.config.from_object('kadi_apps.settings.unit_test')
+    app.config['KADI_FTS_DB'] = str(tmp_path_factory.mktemp('kadi') / 'kadi_apps_fts.db3')
+    app.register_blueprint(kadi_views.blueprint, url_prefix='/kadi')
+    return app
+
+
+def _secs(date):
+    return float(CxoTime(date).secs)
+
+
+@pytest.mark.parametrize('filter_string, plan', [
+    ('start>2013', [('tstart__gt', _secs('2013:001'))]),
+    ('start<=2013:001', [('tstart__lte', _secs('2013:001'))]),
+    ('stop<2014:001:12:00:00', [('tstop__lt', _secs('2014:001:12:00:00'))]),
+    ('2013', [('tstart__gte', _secs('2013:001')), ('tstart__lt', _secs('2014:001'))]),
+    ('2013:001', [('tstart__gte', _secs('2013:001')), ('tstart__lt', _secs('2013:002'))]),
+    ('2012:366', [('tstart__gte', _secs('2012:366')), ('tstart__lt', _secs('2013:001'))]),
+    ('n_dwell=2', [('n_dwell__exact', '2')]),
+    # exact start comparisons are string lookups
+    ('start=2013:001:00:00:00.000', [('start__exact', '2013:001:00:00:00.000')]),
+    # values that are not dates, and prefixes that are not a year or year:doy, stay strings
+    ('start>abc', [('start__gt', 'abc')]),
+    ('2013:400', [('start__startswith', '2013:400')]),
+    ('2013:00', [('start__startswith', '2013:00')]),
+    ('start>2013 dur<=1800', [('tstart__gt', _secs('2013:001')), ('dur__lte', '1800')]),
+])
+def test_compile_filter(filter_string, plan):
+    model = models.get_event_models()['manvr']
+    assert kadi_views.compile_filter(model, filter_string, 'start', 'startswith') == tuple(plan)
+
+
+def test_compile_filter_text():
+    # the example of the filter help
+    model = models.get_event_models()['cap']
+    plan = kadi_views.compile_filter(
+        model, 'sequencer start>2010 stop<2011', 'title', 'icontains'
+    )
+    assert plan == (
+        ('title__icontains', 'sequencer'),
+        ('tstart__gt', _secs('2010:001')),
+        ('tstop__lt', _secs('2011:001')),
+    )
+
+    # each word is a separate lookup, and quoted words are kept together
+    model = models.get_event_models()['major_event']
+    plan = kadi_views.compile_filter(model, 'safe "normal sun"', 'descr', 'icontains')
+    assert plan == (('descr__icontains', 'safe'), ('descr__icontains', 'normal sun'))
+
+    # major events have no tstop, so stop comparisons stay string comparisons
+    field_names = {field.name for field in model.get_model_fields()}
+    assert 'tstop' not in field_names
+    plan = kadi_views.compile_filter(model, 'start>2013 stop<2014', 'descr', 'icontains')
+    assert plan == (('tstart__gt', _secs('2013:001')), ('stop__lt', '2014'))
+
+
+def _get_page(app, model, sort, page, paginate_by, **cursor):
+    field_names = [field.name for field in model.get_model_fields()]
+    query_string = {key: kadi_views._encode_cursor(val) for key, val in cursor.items()}
+    with app.test_request_context('/', query_string=query_string):
+        return kadi_views._get_page_rows(
+            model, model.objects.all(), field_names, sort, page, paginate_by
+        )
+
+
+def _get_expected_pages(model, sort, paginate_by):
+    """Pages of events sorted in python, by sort value and then primary key"""
+    model_pk = model._meta.pk.name
+    sort_field = sort.lstrip('-')
+    field_names = [field.name for field in model.get_model_fields()]
+    rows = [list(row) for row in model.objects.values_list(*field_names)]
+    i_sort, i_pk = field_names.index(sort_field), field_names.index(model_pk)
+    rows = sorted(
+        rows, key=lambda row: (row[i_sort], row[i_pk]), reverse=sort.startswith('-')
+    )
+    return [rows[i0:i0 + paginate_by] for i0 in range(0, len(rows), paginate_by)]
+
+
+@pytest.mark.parametrize('model_name, sort', [
+    ('manvr', 'start'),
+    ('manvr', '-start'),
+    # n_dwell has many ties, so pages are only well defined with the primary key tie-breaker
+    ('manvr', 'n_dwell'),
+    ('manvr', '-n_dwell'),
+    ('dsn_comm', 'activity'),
+    ('dsn_comm', '-tstop'),
+])
+def test_page_cursors(kadi_app, model_name, sort):
+    model = models.get_event_models()[model_name]
+    paginate_by = 7
+    n_pages = 6
+    expected = _get_expected_pages(model, sort, paginate_by)[:n_pages]
+    assert len(expected) == n_pages
+
+    # OFFSET pages (links without a cursor)
+    pages = [
+        _get_page(kadi_app, model, sort, page, paginate_by) for page in range(1, n_pages + 1)
+    ]
+    assert [rows for rows, _, _ in pages] == expected
+
+    # follow the next links and then the previous links back to the first page. The page
+    # number is only used without a cursor, so a wrong one (1) shows that the cursor is used.
+    rows, first_key, last_key = pages[0]
+    for page in range(2, n_pages + 1):
+        rows, first_key, last_key = _get_page(
+            kadi_app, model, sort, 1, paginate_by, after=last_key
+        )
+        assert rows == expected[page - 1]
+    for page in range(n_pages - 1, 0, -1):
+        rows, first_key, last_key = _get_page(
+            kadi_app, model, sort, 1, paginate_by, before=first_key
+        )
+        assert rows == expected[page - 1]
+
+
+def test_page_cursors_fallback(kadi_app):
+    model = models.get_event_models()['manvr']
+    paginate_by = 7
+    last_key = _get_page(kadi_app, model, 'start', 3, paginate_by)[2]
+
+    # invalid cursors are ignored
+    field_names = [field.name for field in model.get_model_fields()]
+    expected = _get_expected_pages(model, 'start', paginate_by)[3]
+    with kadi_app.test_request_context('/', query_string={'after': 'not-a-cursor'}):
+        rows, _, _ = kadi_views._get_page_rows(
+            model, model.objects.all(), field_names, 'start', 4, paginate_by
+        )
+    assert rows == expected
+
+    # sorts on fields that can be null use OFFSET, whatever the cursor
+    nullable = [
+        field.name for field in model.get_model_fields() if field.null and not field.is_relation
+    ]
+    for sort_field in nullable:
+        offset_rows = _get_page(kadi_app, model, sort_field, 4, paginate_by)[0]
+        cursor_rows = _get_page(kadi_app, model, sort_field, 4, paginate_by, after=last_key)[0]
+        assert cursor_rows == offset_rows
+
+
+def test_neighbors():
+    pks = ['a', 'b', 'c', 'd']
+    assert kadi_views._get_neighbors(pks, 'c', 2) == ('b', 'd', 2)
+    assert kadi_views._get_neighbors(pks, 'a', 0) == (None, 'b', 0)
+    assert kadi_views._get_neighbors(pks, 'd', 3) == ('c', None, 3)
+
+    # the database changed since the link was made: the index is found from the key
+    pks = ['a', 'x', 'b', 'c', 'd']
+    assert kadi_views._get_neighbors(pks, 'c', 2) == ('b', 'd', 3)
+    assert kadi_views._get_neighbors(pks, 'a', 40) == (None, 'x', 0)
+    # events that are not in the set anymore are between the events around their old position
+    assert kadi_views._get_neighbors(pks, 'z', 2) == ('x', 'b', 2)
+    assert kadi_views._get_neighbors(pks, 'z', 40) == ('d', None, 5)
+    assert kadi_views._get_neighbors(pks, 'z', -3) == (None, 'a', 0)
+
+    # without an index, neighbors are the events with adjacent keys
+    sorted_pks = ['a', 'c', 'e']
+    assert kadi_views._get_key_neighbors(sorted_pks, 'c') == ('a', 'e')
+    assert kadi_views._get_key_neighbors(sorted_pks, 'b') == ('a', 'c')
+    assert kadi_views._get_key_neighbors(sorted_pks, 'a') == (None, 'c')
+    assert kadi_views._get_key_neighbors(sorted_pks, 'f') == ('e', None)
+
+
+def test_neighbor_index(kadi_app, monkeypatch):
+    model = models.get_event_models()['manvr']
+    version = [1]
+    monkeypatch.setattr(kadi_views, '_get_events_db_version', lambda: version[0])
+    queryset = kadi_views._order_by(model.objects.all(), '-n_dwell', 'start')
+    expected = list(queryset.values_list('start', flat=True))
+    with kadi_app.test_request_context('/'):
+        pks = kadi_views._get_neighbor_index('manvr', queryset, '', '-n_dwell', 'start')
+        assert pks == expected
+        # the keys are cached...
+        empty = model.objects.none()
+        assert kadi_views._get_neighbor_index('manvr', empty, '', '-n_dwell', 'start') is pks
+        sorted_pks = kadi_views._get_sorted_pks('manvr', '', '-n_dwell', pks)
+        assert sorted_pks == sorted(expected)
+        # ... until the database changes
+        version[0] = 2
+        assert kadi_views._get_neighbor_index('manvr', empty, '', '-n_dwell', 'start') == []
+
+        # keys that are already sorted are not copied
+        pks = sorted(expected)
+        assert kadi_views._get_sorted_pks('manvr', '', 'start', pks) is pks
+
+
+def test_neighbors_db_change(kadi_app, monkeypatch):
+    from urllib.parse import urlsplit, parse_qs, unquote
+    from django.db import transaction
+
+    model = models.get_event_models()['manvr']
+    model_pk = model._meta.pk.name
+    sort = '-n_dwell'
+    version = [object()]
+    monkeypatch.setattr(kadi_views, '_get_events_db_version', lambda: version[0])
+    client = kadi_app.test_client()
+
+    def get_neighbors(pk, index):
+        """Keys and indices of the previous and next event links of an event page"""
+        r = client.get(f'/kadi/events/manvr/{pk}', query_string={'sort': sort, 'index': index})
+        assert r.status_code == 200
+        urls = re.findall(r'href="(/kadi/events/manvr/[^"]*)"', r.get_data(as_text=True))
+        urls = [urlsplit(html.unescape(url)) for url in urls]
+        return [
+            (unquote(url.path.split('/')[-1]), int(parse_qs(url.query)['index'][0]))
+            for url in urls if not url.path.endswith('/list/')
+        ]
+
+    def get_pks():
+        queryset = kadi_views._order_by(model.objects.all(), sort, model_pk)
+        return [str(pk) for pk in queryset.values_list(model_pk, flat=True)]
+
+    pks = get_pks()
+    assert get_neighbors(pks[3], 3) == [(pks[2], 2), (pks[4], 4)]
+
+    with transaction.atomic():
+        # the previous event is deleted: links made before find the event from its key
+        model.objects.filter(pk=pks[2]).delete()
+        version[0] = object()
+        assert get_neighbors(pks[3], 3) == [(pks[1], 1), (pks[4], 3)]
+
+        # the event moves to the top of the list
+        model.objects.filter(pk=pks[3]).update(n_dwell=1000)
+        version[0] = object()
+        assert get_pks()[0] == pks[3]
+        assert get_neighbors(pks[3], 3) == [(pks[0], 1)]
+        transaction.set_rollback(True)
+
+    version[0] = object()
+    assert get_pks() == pks
+
+
+@pytest.mark.parametrize('model_name, query', [
+    ('manvr', '/list/?sort=-n_dwell&page=2'),
+    ('major_event', '/list/?filter=safe'),
+    ('manvr', '/{pk}'),
+    ('manvr', '/{pk}?sort=-n_dwell&index=3'),
+])
+def test_page_cache(kadi_app, monkeypatch, model_name, query):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    model = models.get_event_models()[model_name]
+    url = f'/kadi/events/{model_name}' + query.format(pk=model.objects.all()[3].pk)
+    # versions that no other test used, so nothing is cached yet
+    version = [object()]
+    monkeypatch.setattr(kadi_views, '_get_events_db_version', lambda: version[0])
+    client = kadi_app.test_client()
+
+    with CaptureQueriesContext(connection) as queries:
+        r = client.get(url)
+    assert r.status_code == 200
+    assert len(queries) > 0
+    page = r.get_data()
+
+    # the page is served from the cache, without any query...
+    with CaptureQueriesContext(connection) as queries:
+        r = client.get(url)
+    assert r.status_code == 200
+    assert r.get_data() == page
+    assert len(queries) == 0
+
+    # ... until the database changes
+    version[0] = object()
+    with CaptureQueriesContext(connection) as queries:
+        r = client.get(url)
+    assert r.status_code == 200
+    assert r.get_data() == page
+    assert len(queries) > 0
+
+
+@pytest.mark.parametrize('model_name, field_name, text', [
+    ('major_event', 'descr', 'safe'),
+    ('major_event', 'descr', 'SAFE MODE'),
+    ('major_event', 'descr', 'normal sun'),
+    ('major_event', 'note', 'eclipse'),
+    ('cap', 'title', 'sequencer'),
+    ('cap', 'descr', 'dump'),
+    ('dsn_comm', 'activity', 'track'),
+    # characters that are special in LIKE or in FTS5 queries
+    ('major_event', 'descr', '100%'),
+    ('major_event', 'descr', 'a_b'),
+    ('major_event', 'descr', 'a "b" c'),
+])
+def test_fts_filter(kadi_app, model_name, field_name, text):
+    model = models.get_event_models()[model_name]
+    with kadi_app.test_request_context('/'):
+        fts_index = kadi_app.extensions['kadi_fts']
+        assert fts_index.can_search(model, field_name, text)
+        queryset = fts_index.filter(model.objects.all(), field_name, text)
+        expected = model.objects.filter(**{f'{field_name}__icontains': text})
+        assert sorted(queryset.values_list('pk', flat=True)) == sorted(
+            expected.values_list('pk', flat=True)
+        )
+
+
+def test_fts_failure(kadi_app, monkeypatch):
+    model = models.get_event_models()['major_event']
+    fts_index = kadi_app.extensions['kadi_fts']
+    version = [1]
+    monkeypatch.setattr(fts_index, 'get_version', lambda: version[0])
+
+    def update():
+        raise RuntimeError('database is locked')
+    monkeypatch.setattr(fts_index, 'update', update)
+
+    with kadi_app.test_request_context('/'):
+        # the filter falls back to icontains...
+        queryset = fts_index.filter(model.objects.all(), 'descr', 'safe')
+        expected = model.objects.filter(descr__icontains='safe')
+        assert sorted(queryset.values_list('pk', flat=True)) == sorted(
+            expected.values_list('pk', flat=True)
+        )
+    # ... and the index is not used again until the database changes
+    assert not fts_index.can_search(model, 'descr', 'safe')
+    version[0] = 2
+    assert fts_index.can_search(model, 'descr', 'safe')
+
+
+def test_fts_search(kadi_app):
+    model = models.get_event_models()['major_event']
+    client = kadi_app.test_client()
+    r = client.get('/kadi/events/major_event/search.json?text=safe&limit=5')
+    assert r.status_code == 200
+    events = r.get_json()
+    expected = model.objects.filter(descr__icontains='safe') | model.objects.filter(
+        note__icontains='safe'
+    )
+    assert 0 < len(events) <= 5
+    assert len(events) == min(5, expected.count())
+    assert all(
+        'safe' in f"{event['descr']} {event['note']}".lower() for event in events
+    )
+
+    r = client.get('/kadi/events/major_event/search.json?text=safe&field=descr&limit=10000')
+    model_pk = model._meta.pk.name
+    assert sorted(event[model_pk] for event in r.get_json()) == sorted(
+        model.objects.filter(descr__icontains='safe').values_list('pk', flat=True)
+    )
+
+    assert client.get('/kadi/events/manvr/search.json?text=safe').status_code == 404
+    assert client.get('/kadi/events/major_event/search.json?text=sa').status_code == 400
+    assert client.get(
+        '/kadi/events/major_event/search.json?text=safe&field=source'
+    ).status_code == 400
+
+
+def _no_constant(name):
+    raise ValueError(f'{name} is not valid JSON')
+
+
+@pytest.mark.parametrize('model_name, query', [
+    ('manvr', {'filter': 'start>2000:100 n_dwell=2', 'sort': '-angle'}),
+    ('major_event', {'filter': 'safe'}),
+    ('obsid', {'sort': 'obsid'}),
+])
+def test_export(kadi_app, model_name, query):
+    import io
+    import csv
+    import json
+
+    model = models.get_event_models()[model_name]
+    names = [field.name for field in model.get_model_fields()]
+    i_pk = names.index(model._meta.pk.name)
+    client = kadi_app.test_client()
+
+    # the export links of the event list keep its filter and sort
+    r = client.get(f'/kadi/events/{model_name}/list/', query_string=query)
+    assert r.status_code == 200
+    page = r.get_data(as_text=True)
+    url = f'/kadi/events/{model_name}/'
+    list_pks = re.findall(rf'href="{url}([^"/?]+)\?[^"]*index=', page)
+    json_url, csv_url = (
+        html.unescape(re.search(rf'href="({url}list\.{ext}\?.*?)"', page)[1])
+        for ext in ('json', 'csv')
+    )
+    assert len(list_pks) > 0
+
+    r = client.get(json_url)
+    assert r.status_code == 200
+    assert r.mimetype == 'application/json'
+    events = json.loads(r.get_data(as_text=True), parse_constant=_no_constant)
+    with kadi_app.app_context():
+        kadi_events = kadi_views.filter_events(
+            getattr(kadi.events, model_name + 's').all(), query.get('filter', ''),
+            kadi_views.EVENT_LIST[model_name].filter_string_field,
+            kadi_views.EVENT_LIST[model_name].filter_string_op,
+        )
+        assert len(events) == kadi_events.count() > 0
+    assert [str(event[names[i_pk]]) for event in events[:len(list_pks)]] == list_pks
+    assert all(list(event) == names for event in events)
+
+    r = client.get(csv_url)
+    assert r.status_code == 200
+    assert r.mimetype == 'text/csv'
+    rows = list(csv.reader(io.StringIO(r.get_data(as_text=True))))
+    assert rows[0] == names
+    assert len(rows) == len(events) + 1
+    assert [row[i_pk] for row in rows[1:]] == [str(event[names[i_pk]]) for event in events]
+
+
+def test_export_json_nan():
+    blocks = [[(1, float('nan'))], [(2, 1.5), (3, -float('inf'))]]
+    chunks = kadi_views._iter_json(['a', 'b'], blocks)
+    assert ''.join(chunks) == '[{"a": 1, "b": null}, {"a": 2, "b": 1.5}, {"a": 3, "b": null}]'
+    assert ''.join(kadi_views._iter_json(['a'], [])) == '[]'
+
+
+@pytest.mark.parametrize('extension', ['json', 'csv'])
+def test_export_chunks(kadi_app, monkeypatch, extension):
+    model = models.get_event_models()['major_event']
+    n_events = model.objects.count()
+    chunk_rows = 7
+    monkeypatch.setitem(kadi_app.config, 'KADI_EXPORT_CHUNK_ROWS', chunk_rows)
+    client = kadi_app.test_client()
+    r = client.get(f'/kadi/events/major_event/list.{extension}', buffered=False)
+    assert r.is_streamed
+    chunks = [chunk.decode() for chunk in r.response if chunk]
+    r.close()
+
+    # one chunk per block of events (and the list brackets of the JSON output)
+    if extension == 'json':
+        assert chunks[0] == '[' and chunks[-1] == ']'
+        chunks = chunks[1:-1]
+        n_rows = [chunk.count('{') for chunk in chunks]
+    else:
+        n_rows = [len(chunk.splitlines()) for chunk in chunks]
+        n_rows[0] -= 1  # the header
+    assert n_rows == [chunk_rows] * (n_events // chunk_rows) + (
+        [n_events % chunk_rows] if n_events % chunk_rows else []
+    )
+
+
+@pytest.fixture
+def events_db(tmp_path):
+    import sqlite3
+    from contextlib import closing
+
+    path = tmp_path / 'events3.db3'
+    with closing(sqlite3.connect(path)) as db, db:
+        db.execute('CREATE TABLE events (x INTEGER)')
+        db.executemany('INSERT INTO events VALUES (?)', [(1,), (2,), (3,)])
+    return path
+
+
+@pytest.fixture
+def django_connection():
+    from django.db import connection
+    from django.db.backends.base.base import BaseDatabaseWrapper
+    from django.db.backends.signals import connection_created
+    from kadi_apps.blueprints.kadi import snapshot
+
+    settings_dict = connection.settings_dict
+    connection_created.connect(snapshot.set_query_only)
+    yield connection
+    connection_created.disconnect(snapshot.set_query_only)
+    BaseDatabaseWrapper.close(connection)
+    connection.settings_dict = settings_dict
+    if hasattr(connection, 'kadi_snapshot'):
+        del connection.kadi_snapshot
+
+
+def _count_events(connection):
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT COUNT(*) FROM events')
+        return cursor.fetchone()[0]
+
+
+def test_snapshot(events_db, django_connection):
+    import os
+    import sqlite3
+    from contextlib import closing
+    from django.db import OperationalError
+    from kadi_apps.blueprints.kadi import snapshot
+
+    events_snapshot = snapshot.EventsSnapshot(events_db)
+    events_snapshot.start().join()
+    assert events_snapshot.version == os.stat(events_db).st_mtime_ns
+    assert events_snapshot.get_version() is None
+
+    events_snapshot.activate()
+    assert django_connection.settings_dict['NAME'] == events_snapshot.name
+    assert events_snapshot.get_version() == events_snapshot.version
+    assert _count_events(django_connection) == 3
+
+    # snapshots are read-only
+    with pytest.raises(OperationalError):
+        with django_connection.cursor() as cursor:
+            cursor.execute('INSERT INTO events VALUES (4)')
+
+    # the database changes: the connection uses the old snapshot until the new one is loaded
+    old_name, old_version = events_snapshot.name, events_snapshot.version
+    with closing(sqlite3.connect(events_db)) as db, db:
+        db.execute('INSERT INTO events VALUES (4)')
+    os.utime(events_db, ns=(old_version, old_version + 10**9))
+    events_snapshot.activate()
+    events_snapshot._thread.join()
+    assert _count_events(django_connection) == 3
+    assert events_snapshot.get_version() == old_version
+
+    events_snapshot.activate()
+    assert events_snapshot.name != old_name
+    assert events_snapshot.get_version() == old_version + 10**9
+    assert _count_events(django_connection) == 4
+    # the old snapshot is freed
+    with closing(sqlite3.connect(old_name, uri=True)) as db:
+        assert db.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()[0] == 0
+
+
+def test_snapshot_fallback(kadi_app, tmp_path, django_connection):
+    import os
+    import kadi.paths
+    from kadi_apps.blueprints.kadi import snapshot
+
+    # without a snapshot, events are read from the database file
+    with kadi_app.app_context():
+        assert kadi_app.extensions['kadi_snapshot'] is None
+        assert django_connection.settings_dict['NAME'] == kadi.paths.EVENTS_DB_PATH()
+        assert kadi_views._get_events_db_version() == os.stat(
+            kadi.paths.EVENTS_DB_PATH()
+        ).st_mtime_ns
+
+    # the same if the snapshot cannot be loaded
+    events_snapshot = snapshot.EventsSnapshot(tmp_path / 'missing.db3')
+    events_snapshot.start().join()
+    events_snapshot.activate()
+    assert events_snapshot.name is None
+    assert events_snapshot.get_version() is None
+    assert django_connection.settings_dict['NAME'] == kadi.paths.EVENTS_DB_PATH()
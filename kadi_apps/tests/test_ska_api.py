@@ -6,7 +6,9 @@ from astropy.table import Table
 from kadi.commands import get_starcats
 from kadi.commands import get_observations
 
-from kadi_apps.blueprints.ska_api.api import _replace_object_cols_with_str
+from kadi_apps.blueprints.ska_api.api import (
+    _replace_object_cols_with_str, _canonical_kwargs, APIEncoder
+)
 
 
 def test_agasc_star(test_server):
@@ -231,3 +233,588 @@ def test_errors(test_server):
     assert r.reason == 'NOT FOUND'
     assert 'error' in r.json()
     assert re.match('no app module found for URL path', r.json()['error'])
+
+
+def test_canonical_kwargs():
+    assert (
+        _canonical_kwargs({'a': 1, 'b': {'x': 1, 'y': 2}})
+        == _canonical_kwargs({'b': {'y': 2, 'x': 1}, 'a': 1})
+    )
+    assert _canonical_kwargs({'a': [1, 2]}) != _canonical_kwargs({'a': (1, 2)})
+    assert _canonical_kwargs({'a': 1}) != _canonical_kwargs({'a': '1'})
+
+
+def test_cache(test_server):
+    api_url = f"{test_server['url']}/ska_api"
+    obsid = 8008
+    url = f"{api_url}/mica/starcheck/get_att?{obsid=}"
+    stats = requests.get(f"{api_url}/_cache").json()
+    r_1 = requests.get(url)
+    r_2 = requests.get(url)
+    assert r_1.ok and r_2.ok
+    assert r_1.content == r_2.content
+    stats_2 = requests.get(f"{api_url}/_cache").json()
+    assert stats_2['hits'] > stats['hits']
+
+
+def test_streaming_formats(test_server):
+    import json
+    api_url = f"{test_server['url']}/ska_api"
+    start = "2023:100"
+    stop = "2023:101"
+    path = "kadi/commands/states/get_states"
+    response = requests.get(f"{api_url}/{path}?{start=}&{stop=}")
+    assert response.ok
+
+    response_stream = requests.get(f"{api_url}/{path}?{start=}&{stop=}&format=json-stream")
+    assert response_stream.ok
+    assert response_stream.content == response.content
+
+    response_ndjson = requests.get(f"{api_url}/{path}?{start=}&{stop=}&format=ndjson")
+    assert response_ndjson.ok
+    rows = [json.loads(line) for line in response_ndjson.text.splitlines()]
+    assert rows == response.json()
+
+
+def test_table_formats(test_server):
+    import io
+    api_url = f"{test_server['url']}/ska_api"
+    agasc_ids = [44960448, 44965624, 45096160]
+    path = 'agasc/get_stars'
+    stars = Table(requests.get(f"{api_url}/{path}?ids={agasc_ids}").json())
+    cols = ['AGASC_ID', 'RA', 'DEC', 'MAG_ACA']
+
+    response = requests.get(f"{api_url}/{path}?ids={agasc_ids}&format=ecsv")
+    assert response.ok
+    stars_ecsv = Table.read(response.text, format='ascii.ecsv')
+    assert np.all(stars_ecsv[cols] == stars[cols])
+
+    response = requests.get(f"{api_url}/{path}?ids={agasc_ids}&format=fits")
+    assert response.ok
+    stars_fits = Table.read(io.BytesIO(response.content), format='fits')
+    assert np.all(stars_fits[cols] == stars[cols])
+
+    response = requests.get(
+        f"{api_url}/{path}?ids={agasc_ids}", headers={'Accept': 'application/x-npz'}
+    )
+    assert response.ok
+    assert response.headers['Content-Type'] == 'application/x-npz'
+    stars_npz = np.load(io.BytesIO(response.content))
+    for col in cols:
+        assert np.all(stars_npz[col] == stars[col])
+
+    # binary formats are only available for tables
+    response = requests.get(f"{api_url}/mica/starcheck/get_att?obsid=8008&format=npz")
+    assert response.status_code == 400
+
+
+def test_encode_table_rows():
+    import json
+    from astropy.table import MaskedColumn
+
+    table = Table()
+    table['int'] = np.arange(5)
+    table['float'] = [np.nan, np.inf, 0.1, 1e300, -0.0]
+    table['str'] = ['a', 'b, c', 'd"', '\u00e9', '%s']
+    table['bytes'] = np.array(['a', 'b', 'c', 'd', 'e'], dtype='S')
+    table['masked'] = MaskedColumn([1.5, 2.5, 3.5, 4.5, 5.5], mask=[0, 1, 0, 1, 0])
+    table['2d'] = np.arange(10).reshape(5, 2)
+    table['object'] = np.array([1, 'a', None, [1, 2], {'a': 1}], dtype=object)
+
+    # the fast rows encoder gives the same result as encoding the list of dicts
+    rows = [{name: table[name].tolist()[ii] for name in table.colnames} for ii in range(5)]
+    assert APIEncoder(table_format='rows').encode(table) == json.dumps(rows, cls=APIEncoder)
+    assert APIEncoder(table_format='rows').encode(table[:0]) == '[]'
+
+
+def test_batch(test_server):
+    from mica.starcheck import get_att, get_dither
+    api_url = f"{test_server['url']}/ska_api"
+    obsid = 8008
+    calls = [
+        {'path': 'mica/starcheck/get_att', 'kwargs': {'obsid': obsid}},
+        {'path': 'mica/starcheck/get_dither', 'kwargs': {'obsid': obsid}},
+        {'path': 'mica/archive/aca_dark/dark_cal/get_dark_cal_dirs'},
+    ]
+    r = requests.post(f"{api_url}/_batch", json=calls)
+    assert r.ok
+    results = r.json()
+    assert len(results) == 3
+    assert results[0] == {'ok': True, 'result': get_att(obsid=obsid)}
+    assert results[1] == {'ok': True, 'result': get_dither(obsid=obsid)}
+    assert not results[2]['ok']
+    assert results[2]['status'] == 404
+    assert re.match('function get_dark_cal_dirs was not found or is not allowed', results[2]['error'])
+
+    r = requests.post(f"{api_url}/_batch", json={'path': 'mica/starcheck/get_att'})
+    assert r.status_code == 400
+
+
+def test_batch_bad_request(monkeypatch):
+    import werkzeug
+    from flask import Flask
+    from kadi_apps.blueprints.ska_api import api
+
+    def check_n(n):
+        if n < 0:
+            raise werkzeug.exceptions.BadRequest(f'n={n} is negative')
+        if n > 10:
+            raise api.BadRequest(f'n={n} is too large')
+        return list(range(n))
+
+    monkeypatch.setitem(api.REGISTRY, 'test/check_n', check_n)
+    app = Flask(__name__)
+    app.config.from_object('kadi_apps.settings.unit_test')
+    app.register_blueprint(api.blueprint, url_prefix='/api/ska_api')
+    calls = [
+        {'path': 'test/check_n', 'kwargs': {'n': -1}},
+        {'path': 'test/check_n', 'kwargs': {'n': 3}},
+        {'path': 'test/check_n', 'kwargs': {'n': 11}},
+    ]
+    r = app.test_client().post('/api/ska_api/_batch', json=calls)
+    assert r.status_code == 200
+    assert r.get_json() == [
+        {'ok': False, 'error': 'n=-1 is negative', 'status': 400},
+        {'ok': True, 'result': [0, 1, 2]},
+        {'ok': False, 'error': 'n=11 is too large', 'status': 400},
+    ]
+
+
+def test_functions(test_server):
+    api_url = f"{test_server['url']}/ska_api"
+    obsid = 8008
+    r = requests.get(f"{api_url}/mica/starcheck/get_att?{obsid=}")
+    assert r.ok
+    r = requests.get(f"{api_url}/_functions")
+    assert r.ok
+    functions = r.json()['functions']
+    assert 'mica/starcheck/get_att' in functions
+    assert functions['mica/starcheck/get_att']['name'].endswith('.get_att')
+
+
+def test_paging(test_server):
+    api_url = f"{test_server['url']}/ska_api"
+    start = "2023:100"
+    stop = "2023:101"
+    path = "kadi/commands/states/get_states"
+    states = requests.get(f"{api_url}/{path}?{start=}&{stop=}").json()
+    assert len(states) > 3
+
+    r = requests.get(f"{api_url}/{path}?{start=}&{stop=}&offset=0&limit=2")
+    assert r.ok
+    assert r.json() == states[:2]
+    assert r.headers['X-Total-Count'] == str(len(states))
+
+    # follow the next page links until the end
+    pages = r.json()
+    while 'Link' in r.headers:
+        r = requests.get(r.links['next']['url'])
+        assert r.ok
+        pages += r.json()
+    assert pages == states
+    assert 'X-Next-Page-Token' not in r.headers
+
+    page_token = 'garbage'
+    r = requests.get(f"{api_url}/{path}?{start=}&{stop=}&{page_token=}")
+    assert r.status_code == 400
+
+
+def test_paging_columns_where(test_server):
+    api_url = f"{test_server['url']}/ska_api"
+    start = "2023:100"
+    stop = "2023:110"
+    path = "kadi/commands/states/get_states"
+    columns = 'datestart,pitch'
+    where = 'pitch > 90'
+    url = f"{api_url}/{path}?{start=}&{stop=}&{columns=}&{where=}"
+    states = requests.get(url).json()
+    assert len(states) > 3
+
+    # the next page links keep the selection, and their tokens are valid for it
+    r = requests.get(f"{url}&limit=2")
+    assert r.ok
+    pages = r.json()
+    while 'Link' in r.headers:
+        r = requests.get(r.links['next']['url'])
+        assert r.ok
+        pages += r.json()
+    assert pages == states
+
+    # but not for another selection
+    r = requests.get(f"{url}&limit=2")
+    page_token = r.headers['X-Next-Page-Token']
+    for query in [
+        f"{start=}&{stop=}&{columns=}&where=pitch > 100",
+        f"{start=}&{stop=}&columns=datestart&{where=}",
+        f"{start=}&{stop=}&{columns=}&{where=}&table_format=columns",
+    ]:
+        r = requests.get(f"{api_url}/{path}?{query}&{page_token=}")
+        assert r.status_code == 400
+
+
+def test_where():
+    import pytest
+    from kadi_apps.blueprints.ska_api import where
+
+    table = Table()
+    table['a'] = np.arange(6)
+    table['s'] = np.array(['a', 'b', 'c', 'd', 'e', 'f'], dtype='S')
+    assert list(table['a'][where.evaluate('a > 3', table)]) == [4, 5]
+    assert list(table['a'][where.evaluate('1 < a <= 3', table)]) == [2, 3]
+    assert list(table['a'][where.evaluate('(a < 2) | (s == "f")', table)]) == [0, 1, 5]
+    assert list(table['a'][where.evaluate('s in ("b", "c") and not a == 2', table)]) == [1]
+    assert list(table['a'][where.evaluate('a * 2 - 1 > 7', table)]) == [5]
+
+    assert list(table['a'][where.evaluate('a / 2.5 + 1 >= 2', table)]) == [3, 4, 5]
+
+    for expression in [
+        '__import__("os")', 'a.real > 1', 'b > 1', 'a', 'a >', 'a ** 2 > 1',
+        # arithmetic only applies to numbers and numeric columns
+        '"x" * 200000000 == s', 's * 2 == s', '[1] * 10000000000 == a', 'a + True > 1',
+        '(1, 2) + a == a', '(a > 1) * 2 > 1', '"x" + "y" == s',
+    ]:
+        with pytest.raises(where.InvalidExpression):
+            where.evaluate(expression, table)
+
+
+def test_columns_where(test_server):
+    api_url = f"{test_server['url']}/ska_api"
+    start = "2023:100"
+    stop = "2023:101"
+    path = "kadi/commands/states/get_states"
+    states = Table(requests.get(f"{api_url}/{path}?{start=}&{stop=}").json())
+
+    columns = 'datestart,pitch,pcad_mode'
+    where = 'pitch > 90'
+    r = requests.get(f"{api_url}/{path}?{start=}&{stop=}&{columns=}&{where=}")
+    assert r.ok
+    states_api = Table(r.json())
+    assert states_api.colnames == ['datestart', 'pitch', 'pcad_mode']
+    assert np.all(states_api['datestart'] == states['datestart'][states['pitch'] > 90])
+
+    where = 'open("/etc/passwd")'
+    r = requests.get(f"{api_url}/{path}?{start=}&{stop=}&{where=}")
+    assert r.status_code == 400
+
+
+def test_compression(test_server):
+    import gzip
+    api_url = f"{test_server['url']}/ska_api"
+    start = "2023:100"
+    stop = "2023:101"
+    path = "kadi/commands/states/get_states"
+    url = f"{api_url}/{path}?{start=}&{stop=}"
+    states = requests.get(url, headers={'Accept-Encoding': 'identity'})
+    assert 'Content-Encoding' not in states.headers
+    assert 'Accept-Encoding' in states.headers['Vary']
+
+    # stream=True so requests does not decode the body
+    r = requests.get(url, headers={'Accept-Encoding': 'gzip'}, stream=True)
+    assert r.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(r.raw.read()) == states.content
+
+    r = requests.get(f"{url}&format=ndjson", headers={'Accept-Encoding': 'gzip'})
+    assert r.headers['Content-Encoding'] == 'gzip'
+    assert len(r.text.splitlines()) == len(states.json())
+
+
+def test_async(test_server):
+    import time
+    api_url = f"{test_server['url']}/ska_api"
+    start = "2023:100"
+    stop = "2023:101"
+    path = "kadi/commands/states/get_states"
+    states = requests.get(f"{api_url}/{path}?{start=}&{stop=}").json()
+
+    r = requests.get(f"{api_url}/{path}?{start=}&{stop=}&async=1")
+    assert r.status_code == 202
+    job = r.json()
+    assert job['status'] in ('queued', 'running')
+    for _ in range(120):
+        job = requests.get(job['status_url']).json()
+        if job['status'] not in ('queued', 'running'):
+            break
+        time.sleep(1)
+    assert job['status'] == 'done'
+    assert requests.get(job['result_url']).json() == states
+
+    r = requests.get(f"{api_url}/_jobs/{'0' * 32}")
+    assert r.status_code == 404
+
+
+def test_job_done():
+    import tempfile
+    from concurrent.futures import Future
+    from concurrent.futures.process import BrokenProcessPool
+    from kadi_apps.blueprints.ska_api.api import _job_done
+    from kadi_apps.blueprints.ska_api.jobs import JobStore
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        store = JobStore(tempdir, ttl=60)
+        # a job still queued when a pool process dies is marked as failed
+        job_id = store.create('kadi/commands/states/get_states', {})
+        future = Future()
+        future.set_exception(BrokenProcessPool('a process in the pool was terminated'))
+        _job_done(store, job_id, future)
+        status = store.get_status(job_id)
+        assert status['status'] == 'error'
+        assert status['error_status'] == 500
+        assert 'BrokenProcessPool' in status['error']
+
+        # jobs that ran keep the status set by run_job
+        job_id = store.create('kadi/commands/states/get_states', {})
+        store.update(job_id, status='done')
+        future = Future()
+        future.set_result(None)
+        _job_done(store, job_id, future)
+        assert store.get_status(job_id)['status'] == 'done'
+
+
+def test_limiter():
+    import time
+    import threading
+    import pytest
+    from kadi_apps.blueprints.ska_api import limits
+
+    def sleep(secs):
+        time.sleep(secs)
+
+    limiter = limits.Limiter(max_concurrent=1, max_queue=1, timeout=0.5)
+    assert limiter.run(lambda x: x + 1, x=1) == 2
+
+    # one call running, one waiting, and the next one is rejected
+    threads = [threading.Thread(target=limiter.run, args=(sleep,), kwargs={'secs': 0.2})
+               for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.05)
+    with pytest.raises(limits.QueueFull):
+        limiter.run(sleep, secs=0)
+    for thread in threads:
+        thread.join()
+
+    with pytest.raises(limits.Timeout):
+        limiter.run(sleep, secs=1)
+    # the slot is held until the call actually finishes
+    assert limiter.stats()['running'] == 1
+    time.sleep(0.6)
+    assert limiter.stats()['running'] == 0
+    assert limiter.stats()['rejected'] == 1
+    assert limiter.stats()['timeouts'] == 1
+
+
+def test_timing(test_server):
+    import time
+    from kadi_apps.blueprints.ska_api.timing import Timing
+
+    timing = Timing()
+    with timing.phase('encode'):
+        time.sleep(0.02)
+        with timing.phase('replace_object_cols'):
+            time.sleep(0.05)
+    # nested phases are not counted in the outer phase
+    assert timing.durations['encode'] < 0.04
+    assert timing.durations['replace_object_cols'] >= 0.05
+
+    api_url = f"{test_server['url']}/ska_api"
+    r = requests.get(f"{api_url}/kadi/commands/get_cmds?start=2023:100&stop=2023:101")
+    metrics = [metric.split(';')[0] for metric in r.headers['Server-Timing'].split(', ')]
+    assert metrics[:2] == ['resolve', 'args']
+    assert 'total' in metrics
+    assert 'rows=' in r.headers['Server-Timing']
+
+
+def test_single_flight():
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    from kadi_apps.cache import SingleFlight
+
+    single_flight = SingleFlight()
+    calls = []
+
+    def call():
+        calls.append(1)
+        time.sleep(0.2)
+        return len(calls)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [executor.submit(single_flight.do, 'key', call) for _ in range(4)]
+        results = [future.result() for future in futures]
+    assert len(calls) == 1
+    assert [result for result, _ in results] == [1] * 4
+    assert sorted(shared for _, shared in results) == [False, True, True, True]
+    assert single_flight.coalesced == 3
+
+    # calls made after the first one finished run again
+    assert single_flight.do('key', call) == (2, False)
+
+
+def test_tile_stitch():
+    from cxotime import CxoTime
+    from kadi_apps.blueprints.ska_api import tiles
+
+    cmds = Table({'date': [CxoTime(t).date for t in [1000., 1500., 2000., 2500.]]})
+    stitched = tiles.stitch_cmds([cmds[:2], cmds[2:]], 1500., 2500.)
+    assert list(stitched['date']) == list(cmds['date'][1:3])
+
+    # the event starting at t=1800 is in both tiles
+    events = Table({
+        'start': [CxoTime(t).date for t in [1000., 1800., 2200.]],
+        'stop': [CxoTime(t).date for t in [1400., 2300., 2600.]],
+    })
+    stitched = tiles.stitch_events([events[:2], events[1:]], 1500., 2500.)
+    assert list(stitched['start']) == list(events['start'][1:])
+
+
+def test_tiled_calls(test_server):
+    from kadi import events
+    from kadi.commands import get_cmds
+    from kadi_apps.blueprints.ska_api import tiles
+
+    # states are not tiled (see tiles.TILED_FUNCTIONS)
+    tile_cache = tiles.TileCache(cache=None, tile_size=86400, max_tiles=60, ttl=0, recent=0)
+    plan_kwargs = {'start': '2023:100', 'stop': '2023:104'}
+    assert tile_cache.plan('kadi.commands.states.get_states', plan_kwargs) is None
+    assert tile_cache.plan('kadi.commands.get_cmds', plan_kwargs) is not None
+
+    # tiling is enabled in unit_test settings, so these calls are stitched from daily tiles
+    api_url = f"{test_server['url']}/ska_api"
+    start = '2023:100:12:00:00'
+    stop = '2023:104:06:00:00'
+    cmds = get_cmds(start=start, stop=stop)
+    r = requests.get(f"{api_url}/kadi/commands/get_cmds?{start=}&{stop=}")
+    assert r.ok
+    cmds_api = Table(r.json())
+    assert len(cmds_api) == len(cmds)
+    for col in ['date', 'type', 'tlmsid', 'scs', 'step']:
+        assert np.all(cmds_api[col] == cmds[col])
+
+    manvrs = events.manvrs.filter(start=start, stop=stop)
+    r = requests.get(f"{api_url}/kadi/events/manvrs/filter?{start=}&{stop=}")
+    assert r.ok
+    manvrs_api = Table(r.json())
+    assert list(manvrs_api['start']) == [manvr.start for manvr in manvrs]
+    assert list(manvrs_api['stop']) == [manvr.stop for manvr in manvrs]
+
+
+def test_agasc_cone_max_mag(test_server):
+    import agasc
+    ra, dec, radius, date, max_mag = 10., 20., 0.5, '2022:001', 9.5
+    stars = agasc.get_agasc_cone(ra, dec, radius, date=date)
+    stars = stars[stars['MAG_ACA'] <= max_mag]
+    api_url = f"{test_server['url']}/ska_api"
+    response = requests.get(
+        f"{api_url}/agasc/get_agasc_cone?{ra=}&{dec=}&{radius=}&{date=}&{max_mag=}"
+    )
+    stars_api = Table(response.json())
+    assert list(stars_api['AGASC_ID']) == list(stars['AGASC_ID'])
+
+    for max_mag in ['faint', 'True', '[9]']:
+        response = requests.get(
+            f"{api_url}/agasc/get_agasc_cone?{ra=}&{dec=}&{radius=}&{date=}&{max_mag=}"
+        )
+        assert response.status_code == 400
+
+
+def test_agasc_index():
+    import agasc
+    from kadi_apps.blueprints.ska_api.agasc_index import AgascIndex, _same_stars
+
+    max_mag = 8.5
+    index = AgascIndex(max_mag=max_mag, max_radius=2.0)
+    index.load()
+
+    # a star of the AGASC supplement, whose magnitude might be above or below max_mag
+    supplement_id = agasc.get_supplement_table('mags')['agasc_id'][0]
+    star = agasc.get_star(supplement_id)
+    cones = [
+        (10., 20., 1.5, '2022:001', {}),
+        # near the pole and across RA=0
+        (45., 89.7, 1.0, '2022:001', {}),
+        (359.9, -30., 2.0, '2010:001', {}),
+        # Barnard's star, with a high proper motion, years away from its epoch
+        (269.452, 4.693, 0.3, '2035:001', {}),
+        (269.452, 4.693, 0.3, '2035:001', {'pm_filter': False}),
+        (star['RA'], star['DEC'], 0.5, '2022:001', {'use_supplement': True}),
+        (star['RA'], star['DEC'], 0.5, '2022:001', {'use_supplement': False}),
+    ]
+    n_stars = 0
+    for ra, dec, radius, date, kwargs in cones:
+        stars = index.get_agasc_cone(ra, dec, radius, date=date, max_mag=max_mag, **kwargs)
+        expected = agasc.get_agasc_cone(ra, dec, radius, date=date, **kwargs)
+        expected = expected[expected['MAG_ACA'] <= max_mag]
+        # the same stars, in the same order
+        assert list(stars['AGASC_ID']) == list(expected['AGASC_ID'])
+        assert _same_stars(stars, expected), f'{ra=} {dec=} {radius=} {date=} {kwargs=}'
+        n_stars += len(stars)
+    assert n_stars > 0
+
+    # the check done before the index is used
+    assert index.check(n_cones=5)
+
+
+def test_agasc_stars_post(test_server):
+    import agasc
+    agasc_ids = [44960448, 44965624, 45096160]
+    stars = agasc.get_stars(agasc_ids, dates='2022:001')
+    url = f"{test_server['url']}/ska_api/agasc/get_stars"
+    cols = ['AGASC_ID', 'RA', 'DEC', 'MAG_ACA']
+
+    response = requests.post(url, json={'ids': agasc_ids, 'dates': '2022:001'})
+    assert response.ok
+    stars_api = Table(response.json())
+    assert np.all(stars_api.as_array().astype(stars.dtype)[cols] == stars.as_array()[cols])
+
+    response = requests.post(
+        f'{url}?dates=2022:001',
+        data=np.array(agasc_ids, dtype='<i8').tobytes(),
+        headers={'Content-Type': 'application/octet-stream'},
+    )
+    assert response.ok
+    stars_api = Table(response.json())
+    assert np.all(stars_api.as_array().astype(stars.dtype)[cols] == stars.as_array()[cols])
+
+    response = requests.post(url, json=agasc_ids)
+    assert response.status_code == 400
+
+
+def test_etag(test_server):
+    url = f"{test_server['url']}/ska_api/agasc/get_star?id=2758752&date=2022:001"
+    response = requests.get(url)
+    assert response.ok
+    etag = response.headers['ETag']
+    response = requests.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.content == b''
+    assert response.headers['ETag'] == etag
+    response = requests.get(url + '&table_format=columns', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+
+def test_etag_time_default(test_server):
+    # without a date, the star position depends on the time of the call
+    url = f"{test_server['url']}/ska_api/agasc/get_star?id=2758752"
+    etag = requests.get(f"{url}&date=2022:001").headers['ETag']
+    response = requests.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert 'ETag' not in response.headers
+    response = requests.get(url, headers={'If-None-Match': '*'})
+    assert response.status_code == 200
+
+
+def test_depends_on_time():
+    from kadi_apps.blueprints.ska_api import versions
+
+    assert versions.depends_on_time('agasc.get_agasc_cone', {'ra': 1, 'dec': 2})
+    assert not versions.depends_on_time(
+        'agasc.get_agasc_cone', {'ra': 1, 'dec': 2, 'date': '2022:001'}
+    )
+    assert versions.depends_on_time('kadi.commands.states.get_states', {'start': '2022:001'})
+    assert not versions.depends_on_time(
+        'kadi.commands.states.get_states', {'start': '2022:001', 'stop': '2022:002'}
+    )
+    assert not versions.depends_on_time('kadi.commands.get_cmds', {'start': '2022:001'})
+
+    data_versions = versions.DataVersions(ttl=60)
+    assert data_versions.get('agasc.get_agasc_cone', {'ra': 1, 'dec': 2}) is None